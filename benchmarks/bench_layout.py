@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+PeriPage Layout — benchmarks de la mise en page et de la chaîne d'impression
+
+Chaque cas tourne dans son propre processus (pic de RSS isolé) et mesure des rendus
+à froid : cache des blocs désactivé, polices et glyphes déjà chargés.
+
+    python3 benchmarks/bench_layout.py                   # tous les cas, comparés à baseline.json
+    python3 benchmarks/bench_layout.py list_ image_      # cas nommés, ou dont le nom commence par ces préfixes
+    python3 benchmarks/bench_layout.py --save-baseline   # enregistre les résultats comme référence
+    python3 benchmarks/bench_layout.py --check           # code de sortie 1 en cas de régression
+"""
+
+import argparse, io, json, os, platform, random, re, resource, statistics, subprocess, sys, threading, time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+HERE      = os.path.dirname(os.path.abspath(__file__))
+ROOT      = os.path.dirname(HERE)
+SERVICE   = os.path.join(ROOT, "peripage_layout")
+BLUEPRINTS = os.path.join(ROOT, "blueprints")
+BASELINE  = os.path.join(HERE, "baseline.json")
+TOLERANCE = 0.15
+
+# Valeurs d'exemple des expressions Jinja des payloads de blueprints
+BLUEPRINT_VARS = {
+    "prenom": "Sophie",
+    "now().strftime('%A %d %B %Y')": "Vendredi 17 Octobre 2026",
+    "image_url": None,  # serveur d'images local (_serve_images)
+    "encouragement": "Tu vas faire des merveilles aujourd'hui, comme toujours ! 💪",
+    "appointments | tojson": ["08:30 - Dentiste", "12:15 - Déjeuner avec Paul", "18:00 - Piscine 🏊"],
+    "closing": "Bonne journée, on t'aime fort ❤️",
+    "todo_entity": "todo.liste_de_courses",
+    "todo_title": "Liste de courses",
+}
+
+PARAGRAPH = (
+    "Le vent s'était levé dans la nuit et la mer, grise sous un ciel bas, venait battre la digue "
+    "avec une régularité d'horloge. Au bout du quai, le phare clignotait encore, inutile dans le jour "
+    "naissant, et les premiers pêcheurs déroulaient leurs filets en silence. "
+)
+EMOJI_TEXT = "Bonne journée ☀️🌈 ! Courses 🛒🥖🧀🍷, sport 🏃‍♀️🚴, lecture 📚☕ et câlins 🐱🐶❤️ " * 6
+GROCERIES  = ["Pain", "Lait demi-écrémé", "Œufs bio x12", "Pommes Golden", "Café moulu", "Tomates cerises",
+              "Beurre doux", "Yaourts nature", "Papier toilette", "Lessive liquide 2 L pour le linge délicat"]
+
+def _items(count: int) -> list:
+    return [f"{GROCERIES[i % len(GROCERIES)]} ({i + 1})" for i in range(count)]
+
+def blueprint_payload(filename: str, variables: dict) -> dict:
+    """Payload JSON d'un blueprint, expressions Jinja remplacées par des valeurs d'exemple."""
+    with open(os.path.join(BLUEPRINTS, filename), "r", encoding="utf-8") as f:
+        match = re.search(r"payload: >-\n\s+(.+)", f.read())
+    def substitute(m):
+        value = variables[m.group(1).strip()]
+        return value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+    return json.loads(re.sub(r"\{\{(.+?)\}\}", substitute, match.group(1)))
+
+def synthetic_photo(width: int, height: int, fmt: str) -> bytes:
+    """Image pseudo-photographique déterministe (dégradés + bruit), encodée en JPEG ou PNG."""
+    from PIL import Image, ImageFilter
+    noise = Image.frombytes("L", (width, height), random.Random(width * height).randbytes(width * height))
+    noise = noise.filter(ImageFilter.BoxBlur(1))
+    r = Image.linear_gradient("L").resize((width, height))
+    g = Image.radial_gradient("L").resize((width, height))
+    b = Image.blend(noise, r.rotate(90), 0.5)
+    img = Image.merge("RGB", (Image.blend(r, noise, 0.3), g, b))
+    buf = io.BytesIO()
+    img.save(buf, format=fmt, quality=90) if fmt == "JPEG" else img.save(buf, format=fmt, compress_level=6)
+    return buf.getvalue()
+
+# --- Cas : nom → fonction de préparation qui retourne (rendu, octets produits par rendu) ---
+
+def _row_bytes(img) -> int:
+    return (img.width + 7) // 8 * img.height
+
+def case_measure_text(ls):
+    font, size = ls.load_font(ls.FONT_SIZE), ls.FONT_SIZE
+    text = PARAGRAPH * 8
+    return lambda: ls.measure_text(text, font, size), lambda r: 0
+
+def _block_case(ls, block):
+    renderer = ls.BLOCK_RENDERERS[block["type"]]
+    return lambda: renderer(block), _row_bytes
+
+def _page_case(ls, blocks):
+    def run():
+        page, _ = ls.compose_page(blocks)
+        return b"".join(ls.pack_rows(page, ls.MODEL_WIDTHS["A6"][1]))
+    return run, len
+
+def _image_case(ls, data):
+    from PIL import Image
+    def run():
+        img = ls._fit_image(Image.open(io.BytesIO(data)), ls.MAX_IMAGE_HEIGHT, ls.IMAGE_FIT)
+        return ls.prepare_photo(img, {})
+    return run, _row_bytes
+
+CASES = {
+    "measure_text_paragraph": case_measure_text,
+    "text_paragraph":  lambda ls: _block_case(ls, {"type": "text", "text": PARAGRAPH * 8}),
+    "text_emoji":      lambda ls: _block_case(ls, {"type": "text", "text": EMOJI_TEXT}),
+    "title":           lambda ls: _block_case(ls, {"type": "title", "text": "Bonjour Sophie !"}),
+    "list_10":         lambda ls: _block_case(ls, {"type": "list", "items": _items(10)}),
+    "list_100":        lambda ls: _block_case(ls, {"type": "list", "items": _items(100)}),
+    "list_1000":       lambda ls: _block_case(ls, {"type": "list", "items": _items(1000)}),
+    "image_jpeg_12mp": lambda ls: _image_case(ls, synthetic_photo(4000, 3000, "JPEG")),
+    "image_png_4mp":   lambda ls: _image_case(ls, synthetic_photo(1600, 2400, "PNG")),
+    "page_morning_routine": lambda ls: _page_case(ls, blueprint_payload("morning_routine.yaml", {**BLUEPRINT_VARS, "image_url": _serve_images()})["blocks"]),
+    "page_todo_25": lambda ls: _page_case(ls, ls.todo_blocks(
+        {blueprint_payload("todo_print.yaml", BLUEPRINT_VARS)["entity_id"]: _items(25)},
+        blueprint_payload("todo_print.yaml", BLUEPRINT_VARS))),
+    "page_todo_3_lists": lambda ls: _page_case(ls, ls.todo_blocks(
+        {"todo.courses": _items(30), "todo.maison": _items(12), "todo.bricolage": _items(5)}, {"title": "Mes listes"})),
+}
+
+def _serve_images() -> str:
+    """Sert une photo de test en local pour les blocs image_url des blueprints."""
+    photo = synthetic_photo(1200, 1600, "PNG")
+    class Handler(SimpleHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(photo)))
+            self.end_headers()
+            self.wfile.write(photo)
+        def log_message(self, fmt, *args):
+            pass
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/image_00001.png"
+
+def _peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024  # octets sur macOS, Ko sur Linux
+
+def run_case(name: str, seconds: float, min_runs: int) -> dict:
+    """Exécuté dans le processus enfant : importe le service et chronomètre un cas."""
+    sys.argv = ["layout_service.py", "00:00:00:00:00:00", "A6", "DejaVu", "24", "0"]
+    sys.path.insert(0, SERVICE)
+    os.environ.setdefault("PERIPAGE_BACKEND", "fake")
+    import logging
+    logging.disable(logging.WARNING)
+    import layout_service as ls
+    ls.BLOCK_CACHE.budget = 0
+    ls.warm_fonts()
+    run, produced = CASES[name](ls)
+    result = run()  # échauffement : polices, glyphes, imports paresseux de Pillow
+    samples, started = [], time.perf_counter()
+    while len(samples) < min_runs or time.perf_counter() - started < seconds:
+        t = time.perf_counter()
+        result = run()
+        samples.append(time.perf_counter() - t)
+    q = statistics.quantiles(samples, n=20, method="inclusive")
+    return {
+        "runs": len(samples), "renders_per_sec": round(len(samples) / sum(samples), 2),
+        "p50_ms": round(statistics.median(samples) * 1000, 3), "p95_ms": round(q[18] * 1000, 3),
+        "peak_rss_mb": round(_peak_rss_mb(), 1), "bytes": produced(result),
+    }
+
+def _environment() -> dict:
+    from PIL import __version__ as pillow
+    try:
+        import numpy
+        numpy = numpy.__version__
+    except ImportError:
+        numpy = None
+    return {"python": platform.python_version(), "machine": platform.machine(), "pillow": pillow, "numpy": numpy}
+
+def _compare(name: str, result: dict, base: dict, tolerance: float) -> list:
+    """Écarts notables par rapport à la référence : temps, mémoire, octets produits."""
+    if not base:
+        return []
+    issues = []
+    for key in ("p50_ms", "peak_rss_mb"):  # p95 trop bruité sur quelques secondes
+        if base.get(key) and result[key] > base[key] * (1 + tolerance):
+            issues.append(f"{key} {base[key]} → {result[key]} (+{(result[key] / base[key] - 1) * 100:.0f}%)")
+    if base.get("bytes") is not None and result["bytes"] != base["bytes"]:
+        issues.append(f"octets {base['bytes']} → {result['bytes']} (rendu modifié)")
+    return issues
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks de la mise en page PeriPage")
+    parser.add_argument("cases", nargs="*", help="préfixes des cas à lancer (tous par défaut)")
+    parser.add_argument("--seconds", type=float, default=2.0, help="durée minimale de mesure par cas")
+    parser.add_argument("--min-runs", type=int, default=5, help="nombre minimal de rendus par cas")
+    parser.add_argument("--baseline", default=BASELINE, help="fichier de référence")
+    parser.add_argument("--save-baseline", action="store_true", help="enregistre les résultats comme référence")
+    parser.add_argument("--check", action="store_true", help="code de sortie 1 si un cas régresse")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="écart toléré avant de signaler une régression")
+    parser.add_argument("--list", action="store_true", help="liste les cas disponibles")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case, args.seconds, args.min_runs)))
+        return
+    if args.list:
+        print("\n".join(CASES))
+        return
+    prefixes = [p for p in args.cases if p not in CASES]  # un nom exact ne sélectionne que ce cas
+    names = [n for n in CASES if not args.cases or n in args.cases or any(n.startswith(p) for p in prefixes)]
+    if not names:
+        sys.exit(f"Aucun cas ne correspond à : {' '.join(args.cases)}")
+    try:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = {}
+    env = _environment()
+    if baseline.get("environment") and baseline["environment"] != env:
+        print(f"Attention : référence mesurée sur {baseline['environment']}, environnement actuel {env}\n")
+
+    print(f"{'cas':<24} {'rendus/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'RSS Mo':>8} {'octets':>9}  Δp50")
+    results, regressions = {}, 0
+    for name in names:
+        proc = subprocess.run([sys.executable, __file__, "--run-case", name, "--seconds", str(args.seconds),
+                               "--min-runs", str(args.min_runs)], capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(f"{name:<24} ÉCHEC\n{proc.stderr.strip()}")
+            regressions += 1
+            continue
+        result = results[name] = json.loads(proc.stdout.strip().splitlines()[-1])
+        base   = baseline.get("cases", {}).get(name)
+        delta  = f"{(result['p50_ms'] / base['p50_ms'] - 1) * 100:+.0f}%" if base and base.get("p50_ms") else "—"
+        print(f"{name:<24} {result['renders_per_sec']:>9} {result['p50_ms']:>9} {result['p95_ms']:>9} "
+              f"{result['peak_rss_mb']:>8} {result['bytes']:>9}  {delta}")
+        for issue in _compare(name, result, base, args.tolerance):
+            print(f"{'':<24} ⚠ {issue}")
+            regressions += 1
+
+    if args.save_baseline:
+        cases = {**baseline.get("cases", {}), **results} if baseline.get("environment") == env else results
+        with open(args.baseline, "w") as f:
+            json.dump({"environment": env, "cases": cases}, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+        print(f"\nRéférence enregistrée : {args.baseline}")
+    if regressions:
+        print(f"\n{regressions} écart(s) au-delà de {args.tolerance:.0%} par rapport à la référence")
+        if args.check:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,25 @@
 PeriPage Layout Addon — layout_service.py
 """
 
-import sys, json, logging, threading, base64, textwrap, urllib.request, io, os, time
-import peripage as pp
+import sys, json, logging, threading, asyncio, binascii, re, random, socket, tempfile, http.client, urllib.parse, urllib.request, urllib.error, io, os, time, heapq, itertools, uuid, hashlib
+from bisect import bisect_right
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from email.utils import parsedate_to_datetime
+from itertools import accumulate
+from http import HTTPStatus
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageDraw, ImageFont, ImageOps
+
+try:
+    import numpy as np
+except ImportError:  # conversion 1 bit en PIL pur
+    np = None
+
+try:
+    import peripage as pp
+except ImportError:  # seul le backend "fake" est alors disponible
+    pp = None
 
 if len(sys.argv) < 6:
     print("Usage: layout_service.py <MAC> <MODEL> <FONT> <FONT_SIZE> <PORT> [CUSTOM_FONTS_JSON]")
@@ -19,13 +34,164 @@ FONT_SIZE     = int(sys.argv[4])
 PORT          = int(sys.argv[5])
 CUSTOM_FONTS_JSON = sys.argv[6] if len(sys.argv) > 6 else "[]"
 PRINT_WIDTH   = 384
+STARTED       = time.monotonic()
 
-# Polices custom chargées au démarrage : {"NomPolice": ImageFont, ...}
+# Polices custom disponibles : {"NomPolice": chemin du fichier, ...}
 CUSTOM_FONT_CACHE = {}
 
+DATA_DIR = "/data"
+USER_AGENT = "PeriPage-Layout-Addon/1.0"
+
+def _load_options() -> dict:
+    """Lit /data/options.json (config générée par HA). Retourne {} si absent."""
+    try:
+        with open(os.path.join(DATA_DIR, "options.json"), "r") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+OPTIONS = _load_options()
+QUEUE_SIZE    = int(OPTIONS.get("queue_size", 20))
+PERSIST_QUEUE = bool(OPTIONS.get("persist_queue", True))
+BT_KEEPALIVE  = int(OPTIONS.get("bt_keepalive", 60))
+PRINT_ATTEMPTS    = max(1, int(OPTIONS.get("print_attempts", 3)))
+RETRY_BACKOFF     = 1.0
+BLOCK_CACHE_BYTES = int(OPTIONS.get("block_cache_mb", 16)) * 1024 * 1024
+IMAGE_CACHE_BYTES = int(OPTIONS.get("image_cache_mb", 50)) * 1024 * 1024
+RENDER_WORKERS    = max(1, int(OPTIONS.get("render_workers", 2)))
+BLOCK_DEADLINE    = float(OPTIONS.get("block_deadline", 20))
+STREAMING         = bool(OPTIONS.get("streaming", False))
+BAND_HEIGHT       = max(8, int(OPTIONS.get("band_height", 255)))
+PRINT_TIMEOUT     = 30
+DEFAULT_DITHER    = OPTIONS.get("dither", "floyd")
+COALESCE_WINDOW   = float(OPTIONS.get("coalesce_window", 1.5))
+COALESCE_BREAK    = int(OPTIONS.get("coalesce_break", 60))
+COALESCE_MAX      = 10
+SERVER_MODE       = OPTIONS.get("server_mode", "asyncio")
+MAX_BODY_BYTES    = int(OPTIONS.get("max_body_mb", 10)) * 1024 * 1024
+MAX_INFLIGHT_RENDERS = max(1, int(OPTIONS.get("max_inflight_renders", 2)))
+MAX_IMAGE_HEIGHT  = max(0, int(OPTIONS.get("max_image_height", 0)))
+PRINTER_COOLDOWN  = 60
+HA_CACHE_TTL      = float(OPTIONS.get("ha_cache_ttl", 10))
+PRINTER_BACKEND   = OPTIONS.get("printer_backend") or os.environ.get("PERIPAGE_BACKEND", "bluetooth")
+IMAGE_FIT         = OPTIONS.get("image_fit", "scale")
+HTTP_WORKERS      = 8
+KEEPALIVE_TIMEOUT = 15
+BODY_MIN_RATE     = 16 * 1024          # octets/s : en dessous, un body en cours de lecture est abandonné
+RETRY_AFTER       = 2
+RENDER_QUEUE_WAIT = 5                  # s d'attente d'un créneau de rendu (rest_command abandonne à 10 s)
+RENDER_QUEUE_SIZE = HTTP_WORKERS // 2  # requêtes en attente d'un créneau, au-delà : 429
+SPOOL_MEMORY      = 1024 * 1024
+RETRY_BACKOFF_MAX = 16.0
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
 log = logging.getLogger("peripage-layout")
 
+# --- Métriques au format texte Prometheus (GET /metrics), sans dépendance ---
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Metric:
+    """Métrique nommée, une valeur par combinaison d'étiquettes."""
+    registry = []
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self._values = {}
+        self._lock   = threading.Lock()
+        Metric.registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def _labels(self, key: tuple, extra: str = "") -> str:
+        parts = [f'{n}="{v}"' for n, v in zip(self.labels, key)] + ([extra] if extra else [])
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    @staticmethod
+    def _num(value) -> str:
+        return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+    def samples(self) -> list:
+        with self._lock:
+            return [f"{self.name}{self._labels(k)} {self._num(v)}" for k, v in sorted(self._values.items())]
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self.samples()])
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """Jauge fixée par set(), ou lue à chaque export via `collect` : {(étiquettes...): valeur}."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), collect=None):
+        super().__init__(name, help_text, labels)
+        self.collect = collect
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self) -> list:
+        if self.collect is not None:
+            with self._lock:
+                self._values = dict(self.collect())
+        return super().samples()
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self) -> list:
+        lines = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                for bound, n in zip(self.buckets, counts):
+                    le = 'le="%g"' % bound
+                    lines.append(f"{self.name}_bucket{self._labels(key, le)} {n}")
+                le = 'le="+Inf"'
+                lines.append(f"{self.name}_bucket{self._labels(key, le)} {count}")
+                lines.append(f"{self.name}_sum{self._labels(key)} {self._num(total)}")
+                lines.append(f"{self.name}_count{self._labels(key)} {count}")
+        return lines
+
+def render_metrics() -> str:
+    return "\n".join(metric.render() for metric in Metric.registry) + "\n"
+
+STAGE_SECONDS  = Histogram("peripage_stage_seconds", "Durée des étapes : json_parse, fetch, decode, compose, dither, pack, bt_connect, transfer", ("stage",))
+BLOCK_SECONDS  = Histogram("peripage_block_render_seconds", "Durée de rendu d'un bloc (hors cache), par type", ("type",))
+PAGE_ROWS      = Histogram("peripage_page_height_rows", "Hauteur des pages imprimées (lignes de 384 px)", (), (100, 250, 500, 1000, 2000, 4000, 8000, 16000))
+PRINT_RETRIES  = Counter("peripage_print_retries_total", "Tentatives d'impression échouées, par catégorie d'erreur", ("printer", "category"))
+JOBS_TOTAL     = Counter("peripage_jobs_total", "Jobs terminés, par imprimante et état", ("printer", "state"))
+BYTES_SENT     = Counter("peripage_bytes_sent_total", "Octets envoyés aux imprimantes", ("printer",))
+BYTES_SAVED    = Counter("peripage_bytes_saved_total", "Octets évités grâce aux avances papier", ("printer",))
+
+def _observe(stage: str, started: float) -> float:
+    """Enregistre la durée d'une étape commencée à `started` (perf_counter) et la retourne."""
+    elapsed = time.perf_counter() - started
+    STAGE_SECONDS.observe(elapsed, stage=stage)
+    return elapsed
+
 FONT_MAP = {
     "DejaVu":     "/usr/share/fonts/dejavu/DejaVuSans.ttf",
     "DejaVuBold": "/usr/share/fonts/dejavu/DejaVuSans-Bold.ttf",
@@ -38,42 +204,106 @@ FONT_MAP_BOLD = {
     "Liberation": "/usr/share/fonts/liberation/LiberationSans-Bold.ttf",
 }
 
-def load_custom_fonts():
-    """Télécharge et charge les polices custom déclarées dans la config."""
-    global CUSTOM_FONT_CACHE
+# Polices custom conservées sous /data/fonts : <hash url>-<hash contenu>.ttf + <hash url>.json (validateurs HTTP)
+FONT_DIR    = os.path.join(DATA_DIR, "fonts") if os.path.isdir(DATA_DIR) else "/tmp/peripage_fonts"
+FONTS_READY = threading.Event()
+
+def _custom_font_entries() -> list:
+    """[(nom, url), ...] déclarés dans la config."""
     # Lire depuis /data/options.json (fichier config généré par HA)
-    fonts = []
-    try:
-        with open("/data/options.json", "r") as f:
-            options = json.load(f)
-        fonts = options.get("custom_fonts", [])
-    except Exception:
+    if "custom_fonts" in OPTIONS:
+        fonts = OPTIONS["custom_fonts"]
+    else:
         # Fallback sur l'argument CLI
         try:
             fonts = json.loads(CUSTOM_FONTS_JSON)
         except Exception:
             log.warning("Impossible de lire custom_fonts depuis la config")
-            return
-    if not fonts:
-        return
-    for entry in fonts:
+            return []
+    entries = []
+    for entry in fonts or []:
         name = entry.get("name", "").strip()
         url  = entry.get("url", "").strip()
-        if not name or not url:
-            continue
-        dest = f"/tmp/custom_font_{name}.ttf"
+        if name and url:
+            entries.append((name, url))
+    return entries
+
+def _font_meta_path(url: str) -> str:
+    return os.path.join(FONT_DIR, hashlib.sha256(url.encode("utf-8")).hexdigest()[:16] + ".json")
+
+def _stored_font(url: str):
+    """Méta de la copie locale d'une police, ou None."""
+    try:
+        with open(_font_meta_path(url)) as f:
+            meta = json.load(f)
+        return meta if os.path.exists(meta["path"]) else None
+    except Exception:
+        return None
+
+def register_stored_fonts():
+    """Rend disponibles tout de suite les copies locales ; un fichier illisible retombe sur les polices système."""
+    for name, url in _custom_font_entries():
+        meta = _stored_font(url)
+        if meta:
+            CUSTOM_FONT_CACHE[name] = meta["path"]
+
+def _refresh_custom_font(name: str, url: str) -> bool:
+    """Revalide une police (requête conditionnelle) et la télécharge si elle a changé. Retourne True si modifiée."""
+    meta    = _stored_font(url)
+    headers = {"User-Agent": USER_AGENT}
+    if meta:
         try:
-            req = urllib.request.Request(url, headers={"User-Agent": "PeriPage-Layout-Addon/1.0"})
-            with urllib.request.urlopen(req, timeout=15) as resp:
-                data = resp.read()
-            with open(dest, "wb") as f:
+            ImageFont.truetype(meta["path"], 24)
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        except Exception:
+            meta = None  # copie locale corrompue : retéléchargement complet
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=15) as resp:
+            data, resp_headers = resp.read(), resp.headers
+    except urllib.error.HTTPError as e:
+        if meta and e.code == 304:
+            return False
+        log.warning(f"Police custom '{name}' impossible à charger : HTTP {e.code}" + (", copie locale conservée" if meta else ""))
+        return False
+    except Exception as e:
+        log.warning(f"Police custom '{name}' impossible à charger : {e}" + (", copie locale conservée" if meta else ""))
+        return False
+    digest = hashlib.sha256(data).hexdigest()
+    path   = os.path.join(FONT_DIR, f"{os.path.basename(_font_meta_path(url))[:-5]}-{digest[:16]}.ttf")
+    try:
+        os.makedirs(FONT_DIR, exist_ok=True)
+        if not os.path.exists(path):
+            with open(path + ".tmp", "wb") as f:
                 f.write(data)
-            # Test que Pillow peut la lire
-            ImageFont.truetype(dest, 24)
-            CUSTOM_FONT_CACHE[name] = dest
-            log.info(f"Police custom '{name}' chargée depuis {url}")
-        except Exception as e:
-            log.warning(f"Police custom '{name}' impossible à charger : {e}")
+            os.replace(path + ".tmp", path)
+        # Test que Pillow peut la lire
+        ImageFont.truetype(path, 24)
+        with open(_font_meta_path(url) + ".tmp", "w") as f:
+            json.dump({"url": url, "path": path, "sha256": digest, "etag": resp_headers.get("ETag"),
+                       "last_modified": resp_headers.get("Last-Modified")}, f)
+        os.replace(_font_meta_path(url) + ".tmp", _font_meta_path(url))
+    except Exception as e:
+        log.warning(f"Police custom '{name}' impossible à charger : {e}")
+        return False
+    changed = CUSTOM_FONT_CACHE.get(name) != path
+    CUSTOM_FONT_CACHE[name] = path
+    if meta and meta["path"] != path:
+        try: os.remove(meta["path"])
+        except OSError: pass
+    if changed:
+        log.info(f"Police custom '{name}' chargée depuis {url}")
+    return changed
+
+def load_custom_fonts() -> bool:
+    """Revalide et télécharge en parallèle les polices custom. Retourne True si l'une a changé."""
+    entries = _custom_font_entries()
+    if not entries:
+        return False
+    with ThreadPoolExecutor(max_workers=min(8, len(entries)), thread_name_prefix="font") as pool:
+        return any(list(pool.map(lambda entry: _refresh_custom_font(*entry), entries)))
 
 EMOJI_FONT_PATHS = [
     "/usr/share/fonts/NotoEmoji-Regular.ttf",
@@ -107,65 +337,226 @@ def _is_emoji(code: int) -> bool:
         0x2B00  <= code <= 0x2BFF
     )
 
-def load_font(size: int, bold: bool = False, font_name: str = None) -> ImageFont.FreeTypeFont:
+FONT_REGISTRY_SIZE = 64
+
+class FontEntry:
+    """Police chargée et ses métriques, partagées par tous les blocs de même (chemin, taille, bold)."""
+    __slots__ = ("key", "font", "line_height", "avg_width")
+    def __init__(self, key: tuple, font):
+        self.key         = key
+        self.font        = font
+        self.line_height = line_height(font)
+        self.avg_width   = _avg_width(font)
+
+_font_registry = OrderedDict()
+_font_registry_lock = threading.Lock()
+
+def _font_candidates(bold: bool, font_name: str) -> list:
+    """Chemins candidats par ordre de préférence : [(chemin, bold), ...]."""
     name = font_name if font_name else FONT_NAME
-    # 1. Chercher dans les polices custom
+    candidates = []
+    # 1. Polices custom (un seul fichier, bold sans effet)
     if name in CUSTOM_FONT_CACHE:
-        try:
-            return ImageFont.truetype(CUSTOM_FONT_CACHE[name], size)
-        except Exception:
-            pass
-    # 2. Chercher dans les polices système
+        candidates.append((CUSTOM_FONT_CACHE[name], False))
+    # 2. Polices système, 3. fallback vers police globale puis DejaVu
     font_map = FONT_MAP_BOLD if bold else FONT_MAP
-    path = font_map.get(name)
-    # 3. Fallback vers police globale puis DejaVu
-    if not path or not os.path.exists(path):
-        path = font_map.get(FONT_NAME)
-    if not path or not os.path.exists(path):
-        path = font_map.get("DejaVu")
-    if path and os.path.exists(path):
+    for n in (name, FONT_NAME, "DejaVu"):
+        path = font_map.get(n)
+        if path and os.path.exists(path):
+            candidates.append((path, bold))
+    return candidates
+
+def get_font(size: int, bold: bool = False, font_name: str = None) -> FontEntry:
+    """Retourne l'entrée du registre (LRU) pour cette police, en la chargeant au besoin."""
+    candidates = _font_candidates(bold, font_name)
+    path, resolved_bold = candidates[0] if candidates else (None, bold)
+    key = (path, size, resolved_bold)
+    with _font_registry_lock:
+        entry = _font_registry.get(key)
+        if entry is not None:
+            _font_registry.move_to_end(key)
+            return entry
+    font = None
+    for candidate, _ in candidates:
         try:
-            return ImageFont.truetype(path, size)
+            font = ImageFont.truetype(candidate, size)
+            break
         except Exception:
             pass
-    log.warning(f"Police '{name}' introuvable, fallback PIL.")
-    return ImageFont.load_default()
+    if font is None:
+        log.warning(f"Police '{font_name or FONT_NAME}' introuvable, fallback PIL.")
+        font = ImageFont.load_default()
+    entry = FontEntry(key, font)
+    with _font_registry_lock:
+        _font_registry[key] = entry
+        if len(_font_registry) > FONT_REGISTRY_SIZE:
+            _font_registry.popitem(last=False)
+    return entry
+
+def load_font(size: int, bold: bool = False, font_name: str = None) -> ImageFont.FreeTypeFont:
+    return get_font(size, bold, font_name).font
+
+def warm_fonts():
+    """Précharge les polices par défaut et custom aux tailles texte et titre."""
+    for name in [FONT_NAME, *CUSTOM_FONT_CACHE]:
+        for size in (FONT_SIZE, FONT_SIZE + 6):
+            for bold in (False, True):
+                get_font(size, bold, name)
+            _get_emoji_font(size)
 
-_lh_cache = {}
 def line_height(font) -> int:
-    key = id(font)
-    if key not in _lh_cache:
-        dummy = Image.new("L", (PRINT_WIDTH, 10))
-        _lh_cache[key] = ImageDraw.Draw(dummy).textbbox((0, 0), "Ay", font=font)[3] + 4
-    return _lh_cache[key]
+    dummy = Image.new("L", (PRINT_WIDTH, 10))
+    return ImageDraw.Draw(dummy).textbbox((0, 0), "Ay", font=font)[3] + 4
+
+def _avg_width(font) -> int:
+    # Largeur réelle d'un caractère moyen
+    dummy = Image.new("L", (1, 1))
+    return max(1, ImageDraw.Draw(dummy).textbbox((0, 0), "abcdefghij", font=font)[2] // 10)
+
+GLYPH_CACHE_SIZE = 8192
+_glyph_cache = OrderedDict()
+_glyph_lock  = threading.Lock()
+
+def _font_key(font) -> tuple:
+    # Le chemin distingue déjà regular / bold (fichiers différents)
+    return (getattr(font, "path", None) or id(font), getattr(font, "size", 0))
+
+def _font_length(font, text: str) -> float:
+    try:
+        return font.getlength(text)
+    except AttributeError:
+        return font.getsize(text)[0]  # police bitmap PIL (fallback)
+
+def glyph_advance(font, char: str) -> float:
+    """Avance horizontale d'un caractère, en cache LRU par (police, taille, caractère)."""
+    key = (_font_key(font), char)
+    with _glyph_lock:
+        adv = _glyph_cache.get(key)
+        if adv is not None:
+            _glyph_cache.move_to_end(key)
+            return adv
+    adv = _font_length(font, char)
+    with _glyph_lock:
+        _glyph_cache[key] = adv
+        if len(_glyph_cache) > GLYPH_CACHE_SIZE:
+            _glyph_cache.popitem(last=False)
+    return adv
+
+def text_runs(text: str, font, size: int) -> list:
+    """Découpe le texte en segments contigus de même police : [(texte, police), ...]."""
+    emoji_font = _get_emoji_font(size)
+    runs, start, current = [], 0, None
+    for i, char in enumerate(text):
+        f = emoji_font if (emoji_font and _is_emoji(ord(char))) else font
+        if f is not current:
+            if i > start:
+                runs.append((text[start:i], current))
+            start, current = i, f
+    if len(text) > start:
+        runs.append((text[start:], current))
+    return runs
 
 def measure_text(text: str, font, size: int) -> int:
     emoji_font = _get_emoji_font(size)
-    dummy = Image.new("L", (1, 1))
-    draw  = ImageDraw.Draw(dummy)
-    total = 0
+    total = 0.0
     for char in text:
-        f    = emoji_font if (_is_emoji(ord(char)) and emoji_font) else font
-        bbox = draw.textbbox((0, 0), char, font=f)
-        total += bbox[2] - bbox[0]
-    return total
+        f = emoji_font if (emoji_font and _is_emoji(ord(char))) else font
+        total += glyph_advance(f, char)
+    return int(round(total))
 
 def draw_text_with_emoji(draw, pos, text: str, font, size: int, fill=0):
-    emoji_font = _get_emoji_font(size)
+    # Un seul draw.text par segment : le crénage est appliqué à l'intérieur du segment
     x, y = pos
-    for char in text:
-        f = emoji_font if (_is_emoji(ord(char)) and emoji_font) else font
+    for run, f in text_runs(text, font, size):
         try:
-            draw.text((x, y), char, font=f, fill=fill)
+            draw.text((int(round(x)), y), run, font=f, fill=fill)
         except Exception:
-            draw.text((x, y), char, font=font, fill=fill)
+            draw.text((int(round(x)), y), run, font=font, fill=fill)
             f = font
-        bbox = draw.textbbox((0, 0), char, font=f)
-        x += bbox[2] - bbox[0]
-    return x
+        x += sum(glyph_advance(f, char) for char in run)
+    return int(round(x))
+
+TEXT_MARGIN = 8
 
-print_lock    = threading.Lock()
-printer_busy  = threading.Event()
+LineLayout = namedtuple("LineLayout", "text width")
+
+def break_lines(text: str, font, size: int, max_width: int) -> list:
+    """Découpe un texte en lignes d'au plus max_width px, mesurées au pixel près.
+
+    Retourne une liste de LineLayout(text, width) : le rendu n'a plus rien à mesurer.
+    """
+    lines = []
+    for paragraph in text.split("\n"):
+        lines.extend(_break_paragraph(paragraph, font, size, max_width))
+    return lines
+
+def _break_paragraph(text: str, font, size: int, max_width: int) -> list:
+    if not text.strip():
+        return [LineLayout("", 0)]
+    emoji_font = _get_emoji_font(size)
+    # Avances cumulées calculées une seule fois : largeur(i, j) = prefix[j] - prefix[i]
+    prefix = [0.0]
+    prefix.extend(accumulate(
+        glyph_advance(emoji_font if (emoji_font and _is_emoji(ord(c))) else font, c) for c in text
+    ))
+    hyphen = glyph_advance(font, "-")
+    n, start, lines = len(text), 0, []
+    while start < n:
+        while start < n and text[start] == " ":
+            start += 1
+        if start >= n:
+            break
+        # Plus grand end tel que text[start:end] tienne dans max_width
+        end = bisect_right(prefix, prefix[start] + max_width) - 1
+        if end < n:
+            space = text.rfind(" ", start, end + 1)
+            if space > start:
+                end = space
+            else:
+                # Mot trop long : coupe dure, avec trait d'union entre deux lettres
+                cut = max(start + 1, bisect_right(prefix, prefix[start] + max_width - hyphen) - 1)
+                piece = text[start:cut]
+                width = prefix[cut] - prefix[start]
+                if cut < n and text[cut - 1].isalpha() and text[cut].isalpha() and cut - start > 1:
+                    piece, width = piece + "-", width + hyphen
+                lines.append(LineLayout(piece, int(round(width))))
+                start = cut
+                continue
+        line = text[start:end].rstrip(" ")
+        lines.append(LineLayout(line, int(round(prefix[start + len(line)] - prefix[start]))))
+        start = end
+    return lines
+
+class RenderGate:
+    """Rendus simultanés bornés, précédés d'une file d'attente bornée.
+
+    Une requête attend jusqu'à RENDER_QUEUE_WAIT secondes qu'un créneau se libère ;
+    le 429 n'est renvoyé que si la file est pleine ou l'attente écoulée.
+    """
+    def __init__(self, slots: int, queue_size: int, wait: float):
+        self.queue_size = queue_size
+        self.wait       = wait
+        self.waiting    = 0
+        self._slots = threading.BoundedSemaphore(slots)
+        self._lock  = threading.Lock()
+
+    def acquire(self) -> bool:
+        if self._slots.acquire(blocking=False):
+            return True
+        with self._lock:
+            if self.waiting >= self.queue_size:
+                return False
+            self.waiting += 1
+        try:
+            return self._slots.acquire(timeout=self.wait)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+
+    def release(self):
+        self._slots.release()
+
+RENDER_SLOTS = RenderGate(MAX_INFLIGHT_RENDERS, RENDER_QUEUE_SIZE, RENDER_QUEUE_WAIT)
 
 def validate_mac(mac: str) -> bool:
     if mac.lower() == "xx:xx:xx:xx:xx:xx":
@@ -199,32 +590,24 @@ def render_text(block: dict) -> Image.Image:
     align     = block.get("align", "left")
     padding   = int(block.get("padding", 4))
     font_name = block.get("font", None)
-    font = load_font(font_size, bold, font_name)
-    lh   = line_height(font)
-    # Mesure la largeur réelle d'un caractère moyen pour le word-wrap
-    _dummy_img  = Image.new("L", (1, 1))
-    _dummy_draw = ImageDraw.Draw(_dummy_img)
-    _avg_w = max(1, _dummy_draw.textbbox((0, 0), "abcdefghij", font=font)[2] // 10)
-    max_chars = max(10, PRINT_WIDTH // _avg_w)
-    lines = []
-    for paragraph in text.split("\n"):
-        wrapped = textwrap.fill(paragraph, width=max_chars) if paragraph.strip() else ""
-        lines.extend(wrapped.split("\n") if wrapped else [""])
+    entry = get_font(font_size, bold, font_name)
+    font  = entry.font
+    lh    = entry.line_height
+    lines = break_lines(text, font, font_size, PRINT_WIDTH - 2 * TEXT_MARGIN)
     total_h = lh * len(lines) + padding * 2
     img  = Image.new("L", (PRINT_WIDTH, total_h), color=255)
     draw = ImageDraw.Draw(img)
     y = padding
-    for line in lines:
+    for line, w in lines:
         if not line.strip():
             y += lh
             continue
-        w = measure_text(line, font, font_size)
         if align == "center":
             x = max(0, (PRINT_WIDTH - w) // 2)
         elif align == "right":
-            x = max(0, PRINT_WIDTH - w - 8)
+            x = max(0, PRINT_WIDTH - w - TEXT_MARGIN)
         else:
-            x = 8
+            x = TEXT_MARGIN
         draw_text_with_emoji(draw, (x, y), line, font, font_size, fill=0)
         y += lh
     return img
@@ -239,316 +622,2219 @@ def render_list(block: dict) -> Image.Image:
     bullet    = block.get("bullet", "•")
     padding   = 4
     font_name = block.get("font", None)
-    font = load_font(font_size, bold, font_name)
-    lh   = line_height(font)
-    max_chars = max(10, int((PRINT_WIDTH - 24) / (font_size * 0.58)))
+    entry = get_font(font_size, bold, font_name)
+    font  = entry.font
+    lh    = entry.line_height
+    indent = TEXT_MARGIN + font_size
     rendered_lines = []
     for item in items:
-        text    = str(item).strip()
-        wrapped = textwrap.fill(text, width=max_chars)
-        sub     = wrapped.split("\n")
-        rendered_lines.append((sub[0], True))
+        sub = break_lines(str(item).strip(), font, font_size, PRINT_WIDTH - indent - TEXT_MARGIN)
+        rendered_lines.append((sub[0].text, True))
         for continuation in sub[1:]:
-            rendered_lines.append((continuation, False))
+            rendered_lines.append((continuation.text, False))
     total_h = lh * len(rendered_lines) + padding * 2
     img  = Image.new("L", (PRINT_WIDTH, total_h), color=255)
     draw = ImageDraw.Draw(img)
     y = padding
     for line, is_first in rendered_lines:
         if is_first:
-            draw_text_with_emoji(draw, (8, y), bullet, font, font_size, fill=0)
-            draw_text_with_emoji(draw, (8 + font_size, y), line, font, font_size, fill=0)
-        else:
-            draw_text_with_emoji(draw, (8 + font_size, y), line, font, font_size, fill=0)
+            draw_text_with_emoji(draw, (TEXT_MARGIN, y), bullet, font, font_size, fill=0)
+        draw_text_with_emoji(draw, (indent, y), line, font, font_size, fill=0)
         y += lh
     return img
 
-def render_image_url(block: dict) -> Image.Image:
+def _cache_control(headers) -> dict:
+    """Directives Cache-Control : {"max-age": "3600", "no-store": None, ...}."""
+    directives = {}
+    for part in (headers.get("Cache-Control") or "").split(","):
+        name, _, value = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = value.strip('"') or None
+    return directives
+
+def _expires_at(headers) -> float:
+    """Date jusqu'à laquelle la réponse est fraîche (0 = à revalider à chaque usage)."""
+    cc = _cache_control(headers)
+    if "no-cache" in cc or "no-store" in cc:
+        return 0.0
+    if "max-age" in cc:
+        try:
+            return time.time() + max(0, int(cc["max-age"]))
+        except (TypeError, ValueError):
+            return 0.0
+    if headers.get("Expires"):
+        try:
+            return parsedate_to_datetime(headers["Expires"]).timestamp()
+        except (TypeError, ValueError):
+            return 0.0
+    return 0.0
+
+class ImageCache:
+    """Cache disque des blocs image_url : image déjà ajustée (PNG "L") + validateurs HTTP."""
+    def __init__(self, directory: str, budget: int):
+        self.directory = directory
+        self.budget    = budget
+        self._lock     = threading.Lock()
+
+    def _paths(self, url: str) -> tuple:
+        base = os.path.join(self.directory, hashlib.sha256(url.encode("utf-8")).hexdigest())
+        return base + ".png", base + ".json"
+
+    def load(self, url: str) -> tuple:
+        """Retourne (image, méta) ou (None, None)."""
+        if not self.directory:
+            return None, None
+        png, meta_path = self._paths(url)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            img = Image.open(png)
+            img.load()
+            os.utime(png)  # LRU : l'horodatage sert à l'éviction
+            return img, meta
+        except Exception:
+            return None, None
+
+    def store(self, url: str, img: Image.Image, meta: dict):
+        if not self.directory:
+            return
+        png, meta_path = self._paths(url)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if img is not None:
+                img.save(png + ".tmp", format="PNG")
+                os.replace(png + ".tmp", png)
+            with open(meta_path + ".tmp", "w") as f:
+                json.dump(meta, f)
+            os.replace(meta_path + ".tmp", meta_path)
+        except Exception as e:
+            log.warning(f"Cache image : écriture impossible pour {url} : {e}")
+            return
+        self._evict()
+
+    def _evict(self):
+        with self._lock:
+            try:
+                entries = []
+                for name in os.listdir(self.directory):
+                    if name.endswith(".png"):
+                        st = os.stat(os.path.join(self.directory, name))
+                        entries.append((st.st_mtime, st.st_size, name[:-4]))
+            except OSError:
+                return
+            total = sum(size for _, size, _ in entries)
+            for _, size, base in sorted(entries):
+                if total <= self.budget:
+                    break
+                for ext in (".png", ".json"):
+                    try: os.remove(os.path.join(self.directory, base + ext))
+                    except OSError: pass
+                total -= size
+
+IMAGE_CACHE = ImageCache(os.path.join(DATA_DIR, "image_cache") if IMAGE_CACHE_BYTES > 0 and os.path.isdir(DATA_DIR) else None, IMAGE_CACHE_BYTES)
+
+def fetch_image_url(url: str, use_cache: bool = True, max_height: int = 0, fit: str = "scale") -> Image.Image:
+    """Télécharge et ajuste une image, en revalidant la copie en cache (ETag / Last-Modified)."""
+    # Le cache garde l'image déjà ajustée : la clé inclut les paramètres d'ajustement
+    key = f"{url}#{max_height}:{fit}" if max_height else url
+    cached, meta = IMAGE_CACHE.load(key) if use_cache else (None, None)
+    if cached is not None and time.time() < meta.get("expires", 0):
+        return cached
+    headers = {"User-Agent": USER_AGENT}
+    if cached is not None:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=15) as resp:
+            data, resp_headers = resp.read(), resp.headers
+    except urllib.error.HTTPError as e:
+        _observe("fetch", started)
+        if cached is not None and e.code == 304:
+            meta["expires"] = _expires_at(e.headers)
+            IMAGE_CACHE.store(key, None, meta)
+            return cached
+        if cached is not None and e.code >= 500:
+            log.warning(f"Image {url} : HTTP {e.code}, copie en cache utilisée")
+            return cached
+        raise
+    except OSError as e:
+        # URLError, timeout, connexion refusée : mieux vaut une copie périmée que pas d'image
+        _observe("fetch", started)
+        if cached is not None:
+            log.warning(f"Image {url} injoignable ({e}), copie en cache utilisée")
+            return cached
+        raise
+    _observe("fetch", started)
+    img = _fit_image(Image.open(io.BytesIO(data)), max_height, fit)
+    if use_cache and "no-store" not in _cache_control(resp_headers):
+        IMAGE_CACHE.store(key, img, {
+            "url": url, "etag": resp_headers.get("ETag"), "last_modified": resp_headers.get("Last-Modified"),
+            "expires": _expires_at(resp_headers), "fetched": time.time(),
+        })
+    return img
+
+def _fetch_block(block: dict) -> Image.Image:
     url = block.get("url", "").strip()
     if not url:
         raise ValueError("Bloc image_url : champ 'url' manquant")
     if not url.startswith(("http://", "https://")):
         raise ValueError(f"Bloc image_url : URL invalide (schéma non autorisé) : {url}")
-    req = urllib.request.Request(url, headers={"User-Agent": "PeriPage-Layout-Addon/1.0"})
-    with urllib.request.urlopen(req, timeout=15) as resp:
-        data = resp.read()
-    return _fit_image(Image.open(io.BytesIO(data)).convert("L"))
+    return fetch_image_url(url, block.get("cache", True) is not False, *_fit_options(block))
+
+def render_image_url(block: dict) -> Image.Image:
+    if "_fetch_error" in block:
+        raise ValueError(block["_fetch_error"])
+    img = block.get("_fetched")
+    return prepare_photo(_fetch_block(block) if img is None else img, block)
+
+def _b64_to_file(b64: str):
+    """Décode du base64 par morceaux vers un fichier temporaire (mémoire puis disque)."""
+    if b64.startswith("data:"):
+        b64 = b64.partition(",")[2]
+    if re.search(r"\s", b64):
+        b64 = "".join(b64.split())
+    out  = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY)
+    step = 4 * 16384
+    for i in range(0, len(b64), step):
+        out.write(binascii.a2b_base64(b64[i:i + step]))
+    out.seek(0)
+    return out
 
 def render_image_b64(block: dict) -> Image.Image:
     b64 = block.get("image", "").strip()
     if not b64:
         raise ValueError("Bloc image_b64 : champ 'image' manquant")
-    return _fit_image(Image.open(io.BytesIO(base64.b64decode(b64))).convert("L"))
+    with _b64_to_file(b64) as f:
+        return prepare_photo(_fit_image(Image.open(f), *_fit_options(block)), block)
+
+IMAGE_FITS = ("scale", "crop")
 
-def _fit_image(img: Image.Image) -> Image.Image:
-    w, h  = img.size
-    new_h = int(h * PRINT_WIDTH / w)
-    return img.resize((PRINT_WIDTH, new_h), Image.LANCZOS)
+def _fit_options(block: dict) -> tuple:
+    """(hauteur max, mode) d'un bloc image : `max_height` et `fit`, sinon les options globales."""
+    max_height = max(0, int(block.get("max_height", MAX_IMAGE_HEIGHT)))
+    fit        = block.get("fit", IMAGE_FIT)
+    if fit not in IMAGE_FITS:
+        raise ValueError(f"fit inconnu : {fit} (choix : {', '.join(IMAGE_FITS)})")
+    return max_height, fit
+
+def _fit_image(img: Image.Image, max_height: int = 0, fit: str = "scale") -> Image.Image:
+    """Ramène une image ouverte (pas encore décodée) à la largeur d'impression, en niveaux de gris.
+
+    Le gros du travail se fait à résolution réduite : décodage JPEG à l'échelle 1/2 à 1/8
+    (draft), puis réduction entière (reduce) ; seule la dernière étape est un LANCZOS.
+    Au-delà de `max_height`, l'image est coupée (crop) ou réduite (scale).
+    """
+    started = time.perf_counter()
+    w, h = img.size
+    out_w, out_h = PRINT_WIDTH, max(1, round(h * PRINT_WIDTH / w))
+    crop_h = h
+    if max_height and out_h > max_height:
+        if fit == "crop":
+            crop_h, out_h = max(1, round(max_height * w / PRINT_WIDTH)), max_height
+        else:
+            out_w, out_h = max(1, round(w * max_height / h)), max_height
+    if img.format == "JPEG":
+        img.draft("L", (out_w, -(-out_h * h // crop_h)))
+        crop_h = round(crop_h * img.height / h)
+    if crop_h < img.height:
+        img = img.crop((0, 0, img.width, crop_h))
+    if img.mode not in ("L", "RGB", "RGBA"):
+        img = img.convert("L")
+    factor = min(img.width // (out_w * 2), img.height // (out_h * 2))
+    if factor > 1:
+        img = img.reduce(factor)
+    img = img.convert("L").resize((out_w, out_h), Image.LANCZOS)
+    if out_w < PRINT_WIDTH:
+        page = Image.new("L", (PRINT_WIDTH, out_h), color=255)
+        page.paste(img, ((PRINT_WIDTH - out_w) // 2, 0))
+        img = page
+    _observe("decode", started)
+    return img
+
+# --- Conversion 1 bit : tramage des photos et empaquetage des lignes pour l'imprimante ---
+
+DITHER_METHODS = ("threshold", "bayer", "floyd", "atkinson")
+
+# Noyaux de diffusion d'erreur : (dx, dy, poids)
+_DIFFUSION_KERNELS = {
+    "floyd":    ((1, 0, 7 / 16), (-1, 1, 3 / 16), (0, 1, 5 / 16), (1, 1, 1 / 16)),
+    "atkinson": ((1, 0, 1 / 8), (2, 0, 1 / 8), (-1, 1, 1 / 8), (0, 1, 1 / 8), (1, 1, 1 / 8), (0, 2, 1 / 8)),
+}
+
+def _bayer_matrix(n: int = 8):
+    m = np.zeros((1, 1))
+    while m.shape[0] < n:
+        m = np.block([[4 * m, 4 * m + 2], [4 * m + 3, 4 * m + 1]])
+    return (m + 0.5) / m.size * 255
+
+def adjust_tone(img: Image.Image, gamma: float = 1.0, contrast: float = 1.0) -> Image.Image:
+    """Pré-ajustement gamma (>1 éclaircit) puis contraste autour du gris moyen, via une LUT."""
+    if gamma == 1.0 and contrast == 1.0:
+        return img
+    lut = []
+    for v in range(256):
+        x = (v / 255) ** (1 / gamma)
+        x = (x - 0.5) * contrast + 0.5
+        lut.append(min(255, max(0, int(round(x * 255)))))
+    return img.point(lut)
+
+def _error_diffuse(arr, kernel: tuple, threshold: int):
+    """Diffusion d'erreur vectorisée par front d'onde.
+
+    Tous les noyaux ne propagent l'erreur que vers des pixels d'indice t = x + 2y plus grand :
+    les pixels d'un même t sont indépendants et traités d'un seul coup.
+    """
+    h, w = arr.shape
+    pad = 2
+    a = np.zeros((h + pad, w + 2 * pad), dtype=np.float32)
+    a[:h, pad:pad + w] = arr
+    for t in range(w + 2 * (h - 1)):
+        y0 = max(0, (t - w + 2) // 2)
+        y1 = min(h - 1, t // 2)
+        if y0 > y1:
+            continue
+        ys = np.arange(y0, y1 + 1)
+        xs = t - 2 * ys + pad
+        old = a[ys, xs]
+        new = np.where(old < threshold, 0.0, 255.0)
+        a[ys, xs] = new
+        err = old - new
+        for dx, dy, weight in kernel:
+            a[ys + dy, xs + dx] += err * weight
+    return a[:h, pad:pad + w]
+
+def dither(img: Image.Image, method: str = "floyd", threshold: int = 128) -> Image.Image:
+    """Réduit une image "L" en noir et blanc (valeurs 0 / 255), selon l'algorithme choisi."""
+    if method not in DITHER_METHODS:
+        raise ValueError(f"Tramage inconnu '{method}' (valeurs : {', '.join(DITHER_METHODS)})")
+    if np is None:
+        # Repli sans NumPy : seuil ou Floyd–Steinberg natif de PIL
+        if method == "threshold":
+            return img.point(lambda v: 255 if v >= threshold else 0)
+        return img.convert("1").convert("L")
+    arr = np.asarray(img, dtype=np.float32)
+    if method == "threshold":
+        out = arr >= threshold
+    elif method == "bayer":
+        m = _bayer_matrix()
+        tiles = np.tile(m, (arr.shape[0] // m.shape[0] + 1, arr.shape[1] // m.shape[1] + 1))
+        out = arr >= tiles[:arr.shape[0], :arr.shape[1]]
+    else:
+        out = _error_diffuse(arr, _DIFFUSION_KERNELS[method], threshold) >= threshold
+    return Image.fromarray(np.where(out, 255, 0).astype(np.uint8), "L")
+
+def prepare_photo(img: Image.Image, block: dict) -> Image.Image:
+    """Tramage d'un bloc image selon ses options `dither`, `gamma`, `contrast`, `threshold`."""
+    started = time.perf_counter()
+    img = adjust_tone(img, float(block.get("gamma", 1.0)), float(block.get("contrast", 1.0)))
+    img = dither(img, block.get("dither", DEFAULT_DITHER), int(block.get("threshold", 128)))
+    _observe("dither", started)
+    return img
+
+def print_bits(img: Image.Image) -> Image.Image:
+    """Image 1 bit telle qu'imprimée (1 = point noir). Comme printImage de peripage, les gris
+    (séparateurs, anticrénelage du texte) sont tramés en Floyd–Steinberg ; les photos déjà tramées passent telles quelles."""
+    return ImageOps.invert(img).convert("1")
+
+def pack_rows(img: Image.Image, row_bytes: int) -> list:
+    """Lignes 1 bit empaquetées (8 pixels par octet, bit à 1 = point noir), prêtes pour l'imprimante."""
+    bits = print_bits(img)
+    if np is not None:
+        rows   = np.packbits(np.asarray(bits), axis=1)
+        packed = np.zeros((img.height, row_bytes), dtype=np.uint8)
+        width  = min(row_bytes, rows.shape[1])
+        packed[:, :width] = rows[:, :width]
+        return [row.tobytes() for row in packed]
+    data = bits.tobytes()
+    stride = (img.width + 7) // 8
+    return [data[i:i + stride][:row_bytes].ljust(row_bytes, b"\0") for i in range(0, len(data), stride)]
+
+def fit_band(band: Image.Image, row_width: int) -> Image.Image:
+    """Met une bande de 384 px à la largeur de tête du modèle (A6p, A40...)."""
+    if band.width == row_width:
+        return band
+    return band.resize((row_width, max(1, round(band.height * row_width / band.width))), Image.NEAREST)
+
+# --- Encodage : les lignes blanches partent en avance papier plutôt qu'en raster ---
+
+FEED_MIN_ROWS = 8     # en dessous, une commande d'avance ne fait rien gagner
+ROW_DELAY     = 0.01  # pause de peripage après chaque ligne raster
+CHUNK_OVERHEAD = 24   # reset (16 octets) + préambule (8 octets) par paquet de 255 lignes
+FEED_CMD_BYTES = 3    # ESC J n
+
+class RasterEncoder:
+    """Découpe un flux de lignes 1 bit en opérations ("raster", [lignes]) / ("feed", n).
+
+    Les suites de lignes blanches deviennent des avances papier ; celles de fin de page sont supprimées.
+    """
+    def __init__(self, row_bytes: int):
+        self.row_bytes   = row_bytes
+        self.blank       = bytes(row_bytes)
+        self.raster_rows = 0
+        self.feed_rows   = 0
+        self.feed_cmds   = 0
+        self.raster_cmds = 0
+        self.trimmed_rows = 0
+        self._white      = 0
+
+    def encode(self, rows: list) -> list:
+        ops, run = [], []
+        for row in rows:
+            if row == self.blank:
+                self._white += 1
+                continue
+            if self._white:
+                if self._white >= FEED_MIN_ROWS:
+                    if run:
+                        ops.append(("raster", run))
+                        run = []
+                    ops.append(("feed", self._white))
+                else:
+                    run.extend([self.blank] * self._white)
+                self._white = 0
+            run.append(row)
+        if run:
+            ops.append(("raster", run))
+        for op, arg in ops:
+            if op == "raster":
+                self.raster_rows += len(arg)
+                self.raster_cmds += -(-len(arg) // 0xff)
+            else:
+                self.feed_rows += arg
+                self.feed_cmds += -(-arg // 0xff)
+        return ops
+
+    def finish(self):
+        """Fin de page : les lignes blanches en attente ne sont pas envoyées."""
+        self.trimmed_rows, self._white = self._white, 0
+
+    def stats(self) -> dict:
+        bytes_sent = self.raster_rows * self.row_bytes + self.raster_cmds * CHUNK_OVERHEAD + self.feed_cmds * FEED_CMD_BYTES
+        elided = self.feed_rows + self.trimmed_rows
+        return {
+            "raster_rows": self.raster_rows, "feed_rows": self.feed_rows, "trimmed_rows": self.trimmed_rows,
+            "bytes_sent": bytes_sent, "bytes_saved": elided * self.row_bytes - self.feed_cmds * FEED_CMD_BYTES,
+            "time_saved_s": round(elided * ROW_DELAY, 2),
+        }
+
+def send_ops(printer, ops: list):
+    for op, arg in ops:
+        if op == "raster":
+            printer.printRowBytesList(arg)
+        else:
+            while arg > 0:
+                printer.printBreak(min(0xff, arg))
+                arg -= 0xff
 
 BLOCK_RENDERERS = {
     "text": render_text, "title": render_title, "list": render_list,
     "separator": render_separator, "image_url": render_image_url, "image_b64": render_image_b64,
 }
 
-def compose_page(blocks: list) -> tuple:
-    images, warnings = [], []
+# Blocs dont le contenu peut changer à paramètres identiques : jamais mis en cache bitmap
+UNCACHEABLE_BLOCKS = {"image_url"}
+
+class BlockCache:
+    """Cache LRU des bitmaps de blocs rendus, borné en octets."""
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.bytes  = 0
+        self.hits   = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock  = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            img = self._items.get(key)
+            if img is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return img
+
+    def put(self, key: str, img: Image.Image):
+        size = img.width * img.height * len(img.getbands())
+        if size > self.budget:
+            return
+        with self._lock:
+            if key in self._items:
+                return
+            self._items[key] = img
+            self.bytes += size
+            while self.bytes > self.budget:
+                _, old = self._items.popitem(last=False)
+                self.bytes -= old.width * old.height * len(old.getbands())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._items), "bytes": self.bytes, "budget": self.budget}
+
+BLOCK_CACHE = BlockCache(BLOCK_CACHE_BYTES)
+
+def block_cache_key(block: dict) -> str:
+    """Empreinte canonique du bloc et des polices par défaut effectives."""
+    payload = json.dumps({
+        "block": block, "font": FONT_NAME, "font_size": FONT_SIZE, "width": PRINT_WIDTH,
+        "custom_fonts": sorted(CUSTOM_FONT_CACHE.items()),
+    }, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def render_block(block: dict) -> Image.Image:
+    """Rend un bloc via BLOCK_RENDERERS, en réutilisant le bitmap en cache si possible.
+
+    Les images retournées peuvent être partagées : ne pas les modifier.
+    """
+    block_type = block.get("type", "")
+    if block_type in UNCACHEABLE_BLOCKS or block.get("cache") is False or BLOCK_CACHE.budget <= 0:
+        return _timed_render(block_type, block)
+    key = block_cache_key(block)
+    img = BLOCK_CACHE.get(key)
+    if img is None:
+        img = _timed_render(block_type, block)
+        BLOCK_CACHE.put(key, img)
+    return img
+
+def _timed_render(block_type: str, block: dict) -> Image.Image:
+    started = time.perf_counter()
+    img = BLOCK_RENDERERS[block_type](block)
+    BLOCK_SECONDS.observe(time.perf_counter() - started, type=block_type)
+    return img
+
+# Blocs limités par le réseau : lancés tout de suite sur un pool dédié
+NETWORK_BLOCKS = {"image_url"}
+FETCH_WORKERS  = 8
+
+_render_pool = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+_fetch_pool  = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="fetch")
+
+def _needs_fetch(block) -> bool:
+    return isinstance(block, dict) and block.get("type", "") in NETWORK_BLOCKS and "_fetched" not in block and "_fetch_error" not in block
+
+def prefetch_blocks(blocks: list) -> list:
+    """Télécharge les images des blocs réseau avant de prendre un créneau de rendu.
+
+    L'attente réseau ne compte ainsi pas dans MAX_INFLIGHT_RENDERS. Chaque bloc reçoit son image
+    (`_fetched`) ou son erreur (`_fetch_error`), signalée par iter_block_images à sa place dans la page.
+    """
+    pending = {j: (_fetch_pool.submit(_fetch_block, b), time.monotonic()) for j, b in enumerate(blocks) if _needs_fetch(b)}
+    if not pending:
+        return blocks
+    blocks = list(blocks)
+    for j, (future, started) in pending.items():
+        try:
+            blocks[j] = {**blocks[j], "_fetched": future.result(timeout=max(0.0, started + BLOCK_DEADLINE - time.monotonic()))}
+        except FuturesTimeout:
+            future.cancel()
+            blocks[j] = {**blocks[j], "_fetch_error": f"délai de {BLOCK_DEADLINE:g}s dépassé"}
+        except Exception as e:
+            blocks[j] = {**blocks[j], "_fetch_error": str(e)}
+    return blocks
+
+PAGE_TRAILER = 40
+
+def iter_block_images(blocks: list, warnings: list):
+    """Rend les blocs et les produit dans l'ordre de la page ; les erreurs vont dans `warnings`.
+
+    Un élément de `blocks` peut aussi être une Image déjà rendue, reprise telle quelle.
+
+    Les blocs réseau sont lancés d'emblée ; les autres au fil de l'eau, RENDER_WORKERS blocs
+    d'avance, pour que la mémoire ne dépende pas de la longueur de la page.
+    Chaque bloc dispose de BLOCK_DEADLINE secondes à partir de son lancement.
+    """
+    pending = {}
+    def submit(j: int, pool):
+        pending[j] = (pool.submit(render_block, blocks[j]), time.monotonic())
+    for j, block in enumerate(blocks):
+        if _needs_fetch(block):
+            submit(j, _fetch_pool)
+    next_cpu = 0
     for i, block in enumerate(blocks):
+        while next_cpu < len(blocks) and next_cpu <= i + RENDER_WORKERS:
+            nxt = blocks[next_cpu]
+            if next_cpu not in pending and isinstance(nxt, dict) and nxt.get("type", "") in BLOCK_RENDERERS:
+                submit(next_cpu, _render_pool)
+            next_cpu += 1
+        if isinstance(block, Image.Image):
+            # Bitmap déjà rendu (image téléversée, région statique...)
+            yield block
+            continue
         block_type = block.get("type", "")
-        renderer   = BLOCK_RENDERERS.get(block_type)
-        if not renderer:
+        if i not in pending:
             warnings.append(f"Bloc #{i} : type inconnu '{block_type}', ignoré")
             continue
+        future, started = pending.pop(i)
         try:
-            images.append(renderer(block))
+            img = future.result(timeout=max(0.0, started + BLOCK_DEADLINE - time.monotonic()))
+        except FuturesTimeout:
+            future.cancel()
+            warnings.append(f"Bloc #{i} ({block_type}) : délai de {BLOCK_DEADLINE:g}s dépassé, ignoré")
+            log.warning(f"Bloc #{i} ({block_type}) ignoré : délai de {BLOCK_DEADLINE:g}s dépassé")
+            continue
         except Exception as e:
             warnings.append(f"Bloc #{i} ({block_type}) : erreur de rendu — {e}")
             log.warning(f"Bloc #{i} ({block_type}) ignoré : {e}")
-    if not images:
-        return None, warnings
-    images.append(Image.new("L", (PRINT_WIDTH, 40), color=255))
-    total_h = sum(img.height for img in images)
-    page    = Image.new("L", (PRINT_WIDTH, total_h), color=255)
+            continue
+        yield img
+
+def stack_images(images: list) -> Image.Image:
+    """Empile des images de la largeur d'impression, de haut en bas."""
+    started = time.perf_counter()
+    page = Image.new("L", (PRINT_WIDTH, sum(img.height for img in images)), color=255)
     y = 0
     for img in images:
         page.paste(img, (0, y))
         y += img.height
-    return page, warnings
+    _observe("compose", started)
+    return page
+
+def compose_page(blocks: list) -> tuple:
+    warnings = []
+    images = list(iter_block_images(blocks, warnings))
+    if not images:
+        return None, warnings
+    images.append(Image.new("L", (PRINT_WIDTH, PAGE_TRAILER), color=255))
+    return stack_images(images), warnings
+
+def compose_bands(blocks: list, band_height: int, warnings: list):
+    """Compose la page en bandes de `band_height` lignes, produites au fur et à mesure du rendu.
+
+    Seules la bande courante et le bloc en cours sont en mémoire, jamais la page entière.
+    """
+    band, fill, rendered = Image.new("L", (PRINT_WIDTH, band_height), color=255), 0, 0
+    def sources():
+        nonlocal rendered
+        for img in iter_block_images(blocks, warnings):
+            rendered += 1
+            yield img
+        if rendered:
+            yield Image.new("L", (PRINT_WIDTH, PAGE_TRAILER), color=255)
+    for img in sources():
+        y = 0
+        while y < img.height:
+            take = min(band_height - fill, img.height - y)
+            band.paste(img.crop((0, y, PRINT_WIDTH, y + take)), (0, fill))
+            fill += take
+            y    += take
+            if fill == band_height:
+                yield band
+                band, fill = Image.new("L", (PRINT_WIDTH, band_height), color=255), 0
+    if fill:
+        yield band.crop((0, 0, PRINT_WIDTH, fill))
+
+def page_bands(page: Image.Image, band_height: int):
+    """Découpe une page déjà composée en bandes."""
+    for y in range(0, page.height, band_height):
+        yield page.crop((0, y, PRINT_WIDTH, min(page.height, y + band_height)))
 
 MODEL_MAP = {
     "A6":  pp.PrinterType.A6,
     "A6p": pp.PrinterType.A6p,
     "A40": pp.PrinterType.A40,
     "A40p": pp.PrinterType.A40p,
-}
+} if pp is not None else {}
+
+# Largeur de tête de chaque modèle : (pixels, octets par ligne)
+MODEL_WIDTHS = {"A6": (384, 48), "A6p": (576, 72), "A40": (1728, 216), "A40p": (1848, 231)}
+
+class FakePrinter:
+    """Imprimante simulée, pour tester toute la chaîne (tentatives, délais) sans PeriPage.
+
+    Reproduit l'interface de peripage.Printer utilisée ici. Le flux est écrit dans un fichier
+    ou envoyé à un socket TCP (`tcp://hôte:port`), au débit et avec la latence configurés ;
+    `failure_rate` et `stall_rate` provoquent des erreurs et des blocages aléatoires.
+    """
+    def __init__(self, mac: str, model: str):
+        self.mac = mac
+        self.row_width, self.row_bytes = MODEL_WIDTHS.get(model, MODEL_WIDTHS["A6"])
+        self.sink         = os.environ.get("PERIPAGE_FAKE_SINK", "/tmp/peripage_fake.bin")
+        self.bandwidth    = float(os.environ.get("PERIPAGE_FAKE_BANDWIDTH", 4800))  # octets/s, 0 = illimité
+        self.latency      = float(os.environ.get("PERIPAGE_FAKE_LATENCY", 0.02))    # s par commande
+        self.connect_time = float(os.environ.get("PERIPAGE_FAKE_CONNECT", 0.5))
+        self.failure_rate = float(os.environ.get("PERIPAGE_FAKE_FAILURE_RATE", 0))
+        self.stall_rate   = float(os.environ.get("PERIPAGE_FAKE_STALL_RATE", 0))
+        self._out         = None
+
+    def connect(self):
+        time.sleep(self.connect_time)
+        self._fail("[Errno 112] Host is down")
+        if self.sink.startswith("tcp://"):
+            host, _, port = self.sink[6:].rpartition(":")
+            self._out = socket.create_connection((host, int(port)), timeout=5).makefile("wb")
+        else:
+            self._out = open(self.sink, "ab")
+
+    def disconnect(self):
+        if self._out is not None:
+            try:
+                self._out.close()
+            except OSError:
+                pass
+            self._out = None
+
+    def isConnected(self) -> bool:
+        return self._out is not None
+
+    def reset(self):
+        self._send(b"\x10\xff\xfe\x01" + bytes(12))
+
+    def getRowBytes(self) -> int:
+        return self.row_bytes
+
+    def getRowWidth(self) -> int:
+        return self.row_width
+
+    def printBreak(self, size: int = 0x40):
+        self._send(b"\x1b\x4a" + bytes([size & 0xff]))
+
+    def printRowBytesList(self, rows: list, delay: float = ROW_DELAY):
+        # Un en-tête par paquet de 255 lignes, comme la bibliothèque peripage
+        for i in range(0, len(rows), 0xff):
+            chunk = rows[i:i + 0xff]
+            self._send(b"\x1d\x76\x30\x00" + self.row_bytes.to_bytes(2, "little") + len(chunk).to_bytes(2, "little")
+                       + bytes(CHUNK_OVERHEAD - 8) + b"".join(chunk))
+
+    def _fail(self, message: str):
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise OSError(message)
+
+    def _send(self, data: bytes):
+        if self._out is None:
+            raise OSError("[Errno 107] Transport endpoint is not connected")
+        self._fail("timeout")
+        if self.stall_rate and random.random() < self.stall_rate:
+            time.sleep(PRINT_TIMEOUT * 10)  # lien figé : le délai d'inactivité doit le détecter
+        time.sleep(self.latency + (len(data) / self.bandwidth if self.bandwidth > 0 else 0))
+        self._out.write(data)
+        self._out.flush()
+
+def _bluetooth_printer(mac: str, model: str):
+    if pp is None:
+        raise RuntimeError("Module peripage absent : backend bluetooth indisponible")
+    return pp.Printer(mac, MODEL_MAP.get(model, pp.PrinterType.A6))
+
+# Backends d'imprimante : fabrique (mac, modèle) -> objet à l'interface de peripage.Printer
+PRINTER_BACKENDS = {"bluetooth": _bluetooth_printer, "fake": FakePrinter}
+
+# Catégories d'erreurs Bluetooth : (catégorie, motifs, message clair)
+ERROR_CATEGORIES = (
+    ("host_down", ("host is down", "112"), "Imprimante éteinte ou hors de portée Bluetooth"),
+    ("timeout",   ("timeout",), "Timeout — imprimante éteinte, hors de portée ou occupée par une autre connexion"),
+    ("busy",      ("busy", "resource", "16"), "Imprimante occupée — peut-être connectée à l'application mobile"),
+    ("refused",   ("connection refused", "111"), "Connexion refusée par l'imprimante"),
+    ("not_found", ("no such device", "19"), "Imprimante introuvable — vérifiez l'adresse MAC"),
+)
+
+def _error_category(error_str: str) -> tuple:
+    """(catégorie, message clair) d'une erreur Bluetooth."""
+    e = error_str.lower()
+    for category, patterns, message in ERROR_CATEGORIES:
+        if any(p in e for p in patterns):
+            return category, message
+    return "other", f"Erreur Bluetooth : {error_str}"
 
 def _classify_error(error_str: str) -> str:
     """Retourne un message clair selon le type d'erreur Bluetooth."""
-    e = error_str.lower()
-    if "host is down" in e or "112" in e:
-        return "Imprimante éteinte ou hors de portée Bluetooth"
-    if "timeout" in e:
-        return "Timeout — imprimante éteinte, hors de portée ou occupée par une autre connexion"
-    if "busy" in e or "resource" in e or "16" in e:
-        return "Imprimante occupée — peut-être connectée à l'application mobile"
-    if "connection refused" in e or "111" in e:
-        return "Connexion refusée par l'imprimante"
-    if "no such device" in e or "19" in e:
-        return "Imprimante introuvable — vérifiez l'adresse MAC"
-    return f"Erreur Bluetooth : {error_str}"
-
-def _attempt_print(image: Image.Image) -> dict:
-    """Une tentative d'impression. Retourne success + error."""
+    return _error_category(error_str)[1]
+
+class PrinterSession:
+    """Lien Bluetooth persistant : gardé ouvert `keepalive` secondes après le dernier job."""
+    def __init__(self, mac: str, model: str, keepalive: int, name: str = "default", backend: str = "bluetooth"):
+        self.name      = name
+        self.mac       = mac
+        self.model     = model
+        self.backend   = backend
+        self.keepalive = keepalive
+        self.connects  = 0
+        self._printer  = None
+        self._timer    = None
+        self._generation = 0  # incrémenté par invalidate() : périme les connexions en cours
+        self._holds    = 0
+        self._lock     = threading.RLock()
+
+    def acquire(self):
+        """Retourne une imprimante connectée, en réutilisant le lien s'il répond encore.
+
+        La sonde et la connexion se font hors verrou : invalidate() n'attend jamais un lien bloqué.
+        Une connexion qui aboutit après un invalidate() est refermée par le thread qui l'a ouverte.
+        """
+        with self._lock:
+            self._cancel_timer()
+            printer = self._printer
+        if printer is not None:
+            if self._alive(printer):
+                log.info(f"[{self.name}] Lien Bluetooth réutilisé.")
+                return printer
+            log.info(f"[{self.name}] Lien Bluetooth perdu, reconnexion...")
+            self.invalidate()
+        with self._lock:
+            generation = self._generation
+        printer = PRINTER_BACKENDS[self.backend](self.mac, self.model)
+        started = time.perf_counter()
+        printer.connect()
+        _observe("bt_connect", started)
+        with self._lock:
+            if generation == self._generation:
+                self._printer = printer
+                self.connects += 1
+                log.info(f"[{self.name}] Connexion Bluetooth établie.")
+                return printer
+        # Session invalidée pendant la connexion (délai d'inactivité dépassé) : ce lien est orphelin
+        try:
+            printer.disconnect()
+        except Exception:
+            pass
+        raise ConnectionError("connexion abandonnée après le délai d'inactivité")
+
+    def hold(self):
+        """Début d'un lot : le lien reste ouvert entre ses jobs, quel que soit `keepalive`."""
+        with self._lock:
+            self._holds += 1
+
+    def unhold(self):
+        """Fin du lot : le lien est libéré comme après un job isolé."""
+        with self._lock:
+            self._holds -= 1
+        self.release()
+
+    def release(self):
+        """Fin d'un job : arme la fermeture du lien après `keepalive` secondes d'inactivité."""
+        with self._lock:
+            self._cancel_timer()
+            if self._holds:
+                return
+            if self.keepalive <= 0:
+                return self._close()
+            self._timer = threading.Timer(self.keepalive, self._idle_close)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def invalidate(self):
+        """Ferme le lien après une erreur : le prochain acquire() reconnecte, une connexion en cours est abandonnée."""
+        with self._lock:
+            self._generation += 1
+            self._cancel_timer()
+            self._close()
+
+    @staticmethod
+    def _alive(printer) -> bool:
+        # Sonde peu coûteuse : socket ouvert, puis un reset (16 octets) qui échoue si le lien est mort
+        try:
+            if not printer.isConnected():
+                return False
+            printer.reset()
+            return True
+        except Exception:
+            return False
+
+    def _idle_close(self):
+        with self._lock:
+            if self._printer is not None:
+                log.info(f"[{self.name}] Lien Bluetooth fermé après {self.keepalive}s d'inactivité.")
+            self._close()
+
+    def _close(self):
+        if self._printer is None:
+            return
+        try:
+            self._printer.disconnect()
+        except Exception:
+            pass
+        self._printer = None
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+def _attempt_print(job: "PrintJob", session: PrinterSession, final_break: int = 100) -> dict:
+    """Une tentative d'impression, bande par bande. Retourne success + error (+ fatal)."""
     result = {"success": False, "error": None}
+    # Dernier progrès du lien, et rendu en cours : en streaming, l'attente d'un bloc (bornée par
+    # BLOCK_DEADLINE) n'est pas une inactivité du lien
+    progress = [time.monotonic(), False]
     def _thread():
+        timings = {"connect_s": 0.0, "render_s": job.timings.get("render_s", 0.0), "convert_s": 0.0, "transfer_s": 0.0}
         try:
-            printer_type = MODEL_MAP.get(PRINTER_MODEL, pp.PrinterType.A6)
-            printer = pp.Printer(PRINTER_MAC, printer_type)
-            printer.connect()
-            log.info(f"Connecte, envoi image {image.size}...")
-            img_rgb = image.convert("RGB")
-            printer.printImage(img_rgb)
-            printer.printBreak(100)
-            printer.disconnect()
+            started = time.perf_counter()
+            printer = session.acquire()
+            timings["connect_s"] = time.perf_counter() - started
+            encoder = RasterEncoder(printer.getRowBytes())
+            height  = 0
+            # Chaque bande est envoyée pendant que la suivante se rend
+            bands = iter(job.bands())
+            while True:
+                started = time.perf_counter()
+                progress[1] = True
+                band = next(bands, None)
+                progress[0], progress[1] = time.monotonic(), False
+                if band is None:
+                    break
+                timings["render_s"] += time.perf_counter() - started
+                height += band.height
+                started = time.perf_counter()
+                ops = encoder.encode(pack_rows(fit_band(band, printer.getRowWidth()), printer.getRowBytes()))
+                timings["convert_s"] += _observe("pack", started)
+                started = time.perf_counter()
+                send_ops(printer, ops)
+                timings["transfer_s"] += _observe("transfer", started)
+                progress[0] = time.monotonic()
+            encoder.finish()
+            if not height:
+                session.release()
+                result.update(error="Aucun bloc n'a pu être rendu", fatal=True)
+                return
+            printer.printBreak(final_break)
+            session.release()
+            job.page_height = height
+            job.transfer    = encoder.stats()
+            job.timings     = {k: round(v, 4) for k, v in timings.items()}
+            PAGE_ROWS.observe(height)
+            BYTES_SENT.inc(job.transfer["bytes_sent"], printer=session.name)
+            BYTES_SAVED.inc(job.transfer["bytes_saved"], printer=session.name)
             result["success"] = True
-            log.info("Impression transmise avec succes.")
+            log.info(f"[{session.name}] Impression transmise avec succes ({height} lignes, {job.transfer['bytes_sent']} octets, "
+                     f"{job.transfer['feed_rows'] + job.transfer['trimmed_rows']} lignes blanches évitées).")
         except Exception as e:
             result["error"] = str(e)
     t = threading.Thread(target=_thread, daemon=True)
     t.start()
-    t.join(timeout=30)
+    # Délai d'inactivité : une longue page peut durer, mais chaque bande doit progresser
+    while t.is_alive() and (progress[1] or time.monotonic() - progress[0] < PRINT_TIMEOUT):
+        t.join(timeout=1)
     if t.is_alive():
         result["error"] = "timeout"
     return result
 
-def _do_print(image: Image.Image) -> dict:
-    """Tente l'impression jusqu'a 2 fois. Notifie HA en cas d'echec."""
-    max_attempts = 2
+def _do_print(job: "PrintJob", session: PrinterSession, final_break: int = 100) -> dict:
+    """Tente l'impression PRINT_ATTEMPTS fois avec attente exponentielle. Notifie HA en cas d'echec."""
     last_error = None
-    for attempt in range(1, max_attempts + 1):
-        log.info(f"Tentative {attempt}/{max_attempts}...")
-        result = _attempt_print(image)
+    for attempt in range(1, PRINT_ATTEMPTS + 1):
+        log.info(f"[{session.name}] Tentative {attempt}/{PRINT_ATTEMPTS}...")
+        result = _attempt_print(job, session, final_break)
         if result["success"]:
             return result
-        last_error = _classify_error(result["error"] or "inconnue")
-        log.warning(f"Tentative {attempt} echouee : {last_error}")
-        if attempt < max_attempts:
-            log.info("Nouvelle tentative dans 5 secondes...")
-            time.sleep(5)
+        if result.get("fatal"):
+            return {"success": False, "error": result["error"], "fatal": True}
+        session.invalidate()
+        category, last_error = _error_category(result["error"] or "inconnue")
+        PRINT_RETRIES.inc(printer=session.name, category=category)
+        log.warning(f"[{session.name}] Tentative {attempt} echouee : {last_error}")
+        if attempt < PRINT_ATTEMPTS:
+            delay = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** (attempt - 1))
+            log.info(f"Nouvelle tentative dans {delay:g} secondes...")
+            time.sleep(delay)
     # Toutes les tentatives ont échoué
-    log.error(f"Echec apres {max_attempts} tentatives : {last_error}")
-    fire_ha_notification(last_error)
+    log.error(f"[{session.name}] Echec apres {PRINT_ATTEMPTS} tentatives : {last_error}")
+    fire_ha_notification(last_error if session.name == "default" else f"{session.name} : {last_error}")
     return {"success": False, "error": last_error}
 
-def fire_ha_notification(error_msg: str):
-    """Envoie une notification persistante dans HA."""
-    try:
-        token = os.environ.get("SUPERVISOR_TOKEN", "")
-        if not token:
-            return
-        payload = json.dumps({
-            "message": f"Impossible de se connecter à l'imprimante.\n{error_msg}",
-            "title": "PeriPage — Erreur d'impression",
-            "notification_id": "peripage_print_error"
-        }).encode("utf-8")
-        req = urllib.request.Request(
-            "http://supervisor/core/api/services/persistent_notification/create",
-            data=payload,
-            headers={
-                "Authorization": f"Bearer {token}",
-                "Content-Type": "application/json"
-            },
-            method="POST"
-        )
-        urllib.request.urlopen(req, timeout=5)
-        log.info("Notification HA envoyee.")
-    except Exception as e:
-        log.warning(f"Impossible d'envoyer la notification HA : {e}")
+class HAClient:
+    """API Home Assistant via le superviseur : connexions keep-alive réutilisées, lectures en cache court.
 
-def get_todo_items(entity_id: str) -> tuple:
-    """Recupere les items non completes d une liste Todo via l API HA."""
-    token = os.environ.get("SUPERVISOR_TOKEN", "")
-    if not token:
-        return [], "SUPERVISOR_TOKEN absent"
-    try:
+    L'URL de base se change par la variable d'environnement HA_API_URL (faux superviseur local en test).
+    """
+    def __init__(self, base_url: str, ttl: float = 10, pool_size: int = 4, timeout: float = 5):
+        parts          = urllib.parse.urlsplit(base_url)
+        self.https     = parts.scheme == "https"
+        self.netloc    = parts.netloc
+        self.prefix    = parts.path.rstrip("/")
+        self.ttl       = ttl
+        self.pool_size = pool_size
+        self.timeout   = timeout
+        self._idle     = []
+        self._cache    = {}
+        self._lock     = threading.Lock()
+
+    @staticmethod
+    def token() -> str:
+        return os.environ.get("SUPERVISOR_TOKEN", "")
+
+    def _connection(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return cls(self.netloc, timeout=self.timeout)
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method: str, path: str, payload=None):
+        """Requête JSON authentifiée ; une connexion fermée entre-temps par HA est rejouée une fois."""
+        body    = json.dumps(payload).encode("utf-8") if payload is not None else None
+        headers = {"Authorization": f"Bearer {self.token()}", "Content-Type": "application/json"}
+        for attempt in (1, 2):
+            conn   = self._connection()
+            reused = conn.sock is not None
+            try:
+                conn.request(method, self.prefix + path, body, headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if reused and attempt == 1:
+                    continue
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            if resp.status >= 400:
+                raise OSError(f"HTTP {resp.status} sur {path}")
+            return json.loads(data) if data else None
+
+    def cached(self, key, loader, refresh: bool = False):
+        """Valeur de `loader()` gardée `ttl` secondes : une réimpression rapide ne réinterroge pas HA."""
+        now = time.monotonic()
+        with self._lock:
+            hit = self._cache.get(key)
+        if hit and now < hit[0] and not refresh:
+            return hit[1]
+        value = loader()
+        with self._lock:
+            self._cache = {k: v for k, v in self._cache.items() if v[0] > now}
+            self._cache[key] = (now + self.ttl, value)
+        return value
+
+    def todo_items(self, entity_id: str, refresh: bool = False) -> list:
+        """Items non complétés d'une liste Todo (service todo/get_items, repli sur /api/states)."""
+        return self.cached(("todo", entity_id), lambda: self._fetch_todo(entity_id), refresh)
+
+    def _fetch_todo(self, entity_id: str) -> list:
         # Utilise l'API todo/get_items (compatible toutes intégrations modernes)
-        payload = json.dumps({"entity_id": entity_id, "status": "needs_action"}).encode("utf-8")
-        req = urllib.request.Request(
-            "http://supervisor/core/api/services/todo/get_items",
-            data=payload,
-            headers={
-                "Authorization": f"Bearer {token}",
-                "Content-Type": "application/json"
-            },
-            method="POST"
-        )
-        with urllib.request.urlopen(req, timeout=5) as resp:
-            data = json.loads(resp.read())
-        # La réponse est une liste de résultats de service
+        data  = self.request("POST", "/api/services/todo/get_items", {"entity_id": entity_id, "status": "needs_action"})
         items = []
-        for result in data:
+        # La réponse est une liste de résultats de service
+        for result in data or []:
             for item in result.get("attributes", {}).get("items", []):
                 summary = item.get("summary", "").strip()
                 if summary:
                     items.append(summary)
         if not items:
             # Fallback sur /api/states si l'API service ne retourne rien
-            req2 = urllib.request.Request(
-                f"http://supervisor/core/api/states/{entity_id}",
-                headers={"Authorization": f"Bearer {token}"}
-            )
-            with urllib.request.urlopen(req2, timeout=5) as resp2:
-                state = json.loads(resp2.read())
+            state = self.request("GET", f"/api/states/{urllib.parse.quote(entity_id)}") or {}
             for item in state.get("attributes", {}).get("items", []):
                 if item.get("status") != "completed":
                     summary = item.get("summary", "").strip()
                     if summary:
                         items.append(summary)
-        return items, None
+        return items
+
+HA = HAClient(os.environ.get("HA_API_URL", "http://supervisor/core"), HA_CACHE_TTL)
+
+def fire_ha_notification(error_msg: str):
+    """Envoie une notification persistante dans HA."""
+    if not HA.token():
+        return
+    try:
+        HA.request("POST", "/api/services/persistent_notification/create", {
+            "message": f"Impossible de se connecter à l'imprimante.\n{error_msg}",
+            "title": "PeriPage — Erreur d'impression",
+            "notification_id": "peripage_print_error"
+        })
+        log.info("Notification HA envoyee.")
+    except Exception as e:
+        log.warning(f"Impossible d'envoyer la notification HA : {e}")
+
+def get_todo_items(entity_id: str, refresh: bool = False) -> tuple:
+    """Recupere les items non completes d une liste Todo via l API HA."""
+    if not HA.token():
+        return [], "SUPERVISOR_TOKEN absent"
+    try:
+        return HA.todo_items(entity_id, refresh), None
     except Exception as e:
         return [], f"Erreur API HA : {e}"
 
+def get_todo_lists(entity_ids: list, refresh: bool = False) -> tuple:
+    """Plusieurs listes Todo récupérées en parallèle. Retourne ({entity_id: items}, erreur)."""
+    futures = {entity_id: _fetch_pool.submit(get_todo_items, entity_id, refresh) for entity_id in entity_ids}
+    lists   = {}
+    for entity_id, future in futures.items():
+        items, err = future.result()
+        if err:
+            return {}, f"{entity_id} : {err}"
+        lists[entity_id] = items
+    return lists, None
+
 
-def send_to_printer(image: Image.Image) -> tuple:
-    global printer_busy
-    if not print_lock.acquire(blocking=False):
-        return False, "Imprimante occupée"
-    printer_busy.set()
+PRIORITIES = {"low": -10, "normal": 0, "high": 10}
+
+def _parse_priority(value) -> int:
+    """Priorité d'un job : entier ou 'low' / 'normal' / 'high'."""
+    if isinstance(value, str) and value.strip().lower() in PRIORITIES:
+        return PRIORITIES[value.strip().lower()]
     try:
-        result = _do_print(image)
-        return result["success"], result.get("error")
-    finally:
-        printer_busy.clear()
-        try: print_lock.release()
-        except RuntimeError: pass
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+class PrintJob:
+    """Un travail d'impression suivi par le spooler (états : queued, printing, done, failed).
+
+    Porte soit une page déjà composée (`page`), soit des blocs rendus en streaming à l'impression (`blocks`).
+    `target` désigne une imprimante ou un pool (None : n'importe laquelle) ; `printer` celle qui l'a pris.
+    """
+    def __init__(self, page: Image.Image = None, priority: int = 0, source: str = "print", job_id: str = None, created: float = None, blocks: list = None, target: str = None):
+        self.id       = job_id or uuid.uuid4().hex[:12]
+        self.page     = page
+        self.blocks   = blocks
+        self.streaming = blocks is not None
+        self.warnings = []
+        self.transfer = None
+        self.timings  = {}
+        self.batch_size = None
+        self.page_height = page.height if page is not None else None
+        self.priority = priority
+        self.source   = source
+        self.target   = target
+        self.printer  = None
+        self.tried    = set()
+        self.state    = "queued"
+        self.error    = None
+        self.created  = created or time.time()
+        self.started  = None
+        self.finished = None
+
+    def to_dict(self) -> dict:
+        d = {
+            "id": self.id, "state": self.state, "priority": self.priority, "source": self.source, "target": self.target, "printer": self.printer,
+            "error": self.error, "created": self.created, "started": self.started, "finished": self.finished,
+            "page_height": self.page_height, "streaming": self.streaming, "warnings": self.warnings, "transfer": self.transfer, "timings": self.timings, "batch_size": self.batch_size,
+        }
+        if self.started:
+            d["wait_s"] = round(self.started - self.created, 3)
+        if self.started and self.finished:
+            d["print_s"] = round(self.finished - self.started, 3)
+        return d
+
+    def bands(self):
+        """Bandes à transmettre ; en streaming, la page est composée pendant l'envoi."""
+        if self.page is not None:
+            return page_bands(self.page, BAND_HEIGHT)
+        self.warnings = []
+        return compose_bands(self.blocks, BAND_HEIGHT, self.warnings)
+
+class PrintSpooler:
+    """File d'attente bornée (priorité puis FIFO) consommée par le worker d'une imprimante."""
+    def __init__(self, max_size: int, spool_dir: str = None, history: int = 50, session: PrinterSession = None, pool: str = None):
+        self.max_size   = max_size
+        self.spool_dir  = spool_dir
+        self.history    = history
+        self.session    = session
+        self.name       = session.name if session else "default"
+        self.pool       = pool
+        self.busy       = threading.Event()
+        self.down_until = 0.0
+        self.dispatcher = None
+        self.jobs       = {}
+        self._heap      = []
+        self._seq       = itertools.count()
+        self._cond      = threading.Condition()
+
+    def depth(self) -> int:
+        with self._cond:
+            return len(self._heap)
+
+    def load(self) -> int:
+        """Jobs en attente, plus celui en cours d'impression."""
+        with self._cond:
+            return len(self._heap) + self.busy.is_set()
+
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+    def status(self) -> dict:
+        with self._cond:
+            done   = sum(1 for j in self.jobs.values() if j.state == "done")
+            failed = sum(1 for j in self.jobs.values() if j.state == "failed")
+        return {"name": self.name, "mac": self.session.mac, "model": self.session.model, "pool": self.pool, "backend": self.session.backend,
+                "busy": self.busy.is_set(), "healthy": self.healthy(), "queue_depth": self.depth(),
+                "connects": self.session.connects, "done": done, "failed": failed}
+
+    def submit(self, job: PrintJob) -> bool:
+        """Ajoute un job. Retourne False si la file est pleine."""
+        if self.depth() >= self.max_size:
+            return False
+        # Écrit avant d'entrer en file (hors verrou : encoder une longue page prend du temps),
+        # pour que le worker ne puisse pas terminer le job avant qu'il soit sur disque
+        self._persist(job)
+        with self._cond:
+            accepted = len(self._heap) < self.max_size
+            if accepted:
+                heapq.heappush(self._heap, (-job.priority, next(self._seq), job))
+                self.jobs[job.id] = job
+                # Remis à zéro ici, sous le verrou : un job basculé garde son état tant qu'aucune file ne l'accepte
+                job.state, job.started, job.printer = "queued", None, self.name
+                self._cond.notify()
+        if not accepted:
+            self._unpersist(job)
+        return accepted
+
+    def get(self, job_id: str):
+        with self._cond:
+            return self.jobs.get(job_id)
+
+    def list(self) -> list:
+        with self._cond:
+            return [job.to_dict() for job in self.jobs.values()]
+
+    def start(self):
+        self._restore()
+        threading.Thread(target=self._worker, name=f"printer-{self.name}", daemon=True).start()
+
+    def _next_job(self, timeout: float = None):
+        """Job en tête de file, attendu au plus `timeout` secondes (sans limite si None)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while not self._heap:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            return heapq.heappop(self._heap)[2]
+
+    def _worker(self):
+        while True:
+            batch = [self._next_job()]
+            try:
+                self._print_batch(batch)
+            except Exception as e:
+                # Un job défectueux ne doit pas tuer le worker : le lot échoue, l'imprimante continue
+                log.exception(f"[{self.name}] Erreur inattendue pendant un lot : {e}")
+                for job in batch:
+                    if job.printer == self.name and job.state in ("queued", "printing"):
+                        try:
+                            self._finish(job, {"success": False, "error": f"Erreur interne : {e}"})
+                        except Exception:
+                            job.state = "failed"
+            finally:
+                self.busy.clear()
+            if len(batch) > 1:
+                log.info(f"[{self.name}] {len(batch)} jobs imprimés dans une même session Bluetooth")
+
+    def _print_batch(self, batch: list):
+        """Imprime le job de `batch` puis, dans la même session Bluetooth, ceux qui arrivent entre-temps.
+
+        Le premier job part aussitôt. Après chaque page, les jobs en file sont enchaînés avec une
+        courte avance ; la session reste ouverte COALESCE_WINDOW secondes après la dernière page
+        (même avec bt_keepalive à 0) pour accueillir un retardataire. Au plus COALESCE_MAX jobs par lot.
+        Si l'imprimante est injoignable, les jobs déjà en file basculent vers une autre imprimante,
+        ou à défaut échouent sans refaire les tentatives.
+        """
+        unreachable = None
+        job = batch[0]
+        self.session.hold()
+        try:
+            while job is not None:
+                if not (unreachable and self._failover(job)):
+                    self.busy.set()
+                    job.state, job.started = "printing", time.time()
+                    if unreachable:
+                        result = {"success": False, "error": unreachable}
+                    else:
+                        try:
+                            # Avance complète seulement si rien n'attend derrière
+                            result = _do_print(job, self.session, COALESCE_BREAK if self.depth() else 100)
+                        except Exception as e:
+                            result = {"success": False, "error": str(e), "fatal": True}
+                        if result["success"]:
+                            self.down_until = 0.0
+                        elif not result.get("fatal"):
+                            unreachable = result["error"]
+                            self._mark_down()
+                            if self._failover(job):
+                                result = None
+                    if result is not None:
+                        self._finish(job, result)
+                    self.busy.clear()
+                if len(batch) >= COALESCE_MAX:
+                    break
+                # Lien injoignable : seuls les jobs déjà en file sont écoulés, sans attendre
+                job = self._next_job(0 if unreachable else COALESCE_WINDOW)
+                if job is not None:
+                    batch.append(job)
+        finally:
+            for member in batch:
+                member.batch_size = len(batch)
+            self.session.unhold()
+
+    def _failover(self, job: PrintJob) -> bool:
+        if self.dispatcher is None or not self.dispatcher.redispatch(job, self):
+            return False
+        with self._cond:
+            self.jobs.pop(job.id, None)
+        self._unpersist(job)
+        return True
+
+    def _mark_down(self):
+        """Imprimante injoignable : écartée PRINTER_COOLDOWN s, ses jobs non ciblés partent ailleurs."""
+        self.down_until = time.monotonic() + PRINTER_COOLDOWN
+        if self.dispatcher is None:
+            return
+        with self._cond:
+            movable    = [entry for entry in self._heap if entry[2].target != self.name]
+            self._heap = [entry for entry in self._heap if entry[2].target == self.name]
+            heapq.heapify(self._heap)
+        for entry in movable:
+            if not self._failover(entry[2]):
+                with self._cond:
+                    heapq.heappush(self._heap, entry)
+
+    def _finish(self, job: PrintJob, result: dict):
+        job.finished = time.time()
+        job.state    = "done" if result["success"] else "failed"
+        job.error    = result.get("error")
+        job.page     = None
+        job.blocks   = None
+        self._unpersist(job)
+        self._trim()
+        JOBS_TOTAL.inc(printer=self.name, state=job.state)
+        log.info(f"[{self.name}] Job {job.id} {job.state} en {job.finished - (job.started or job.finished):.1f}s")
+
+    def _trim(self):
+        with self._cond:
+            finished = [j for j in self.jobs.values() if j.state in ("done", "failed")]
+            for job in finished[:max(0, len(finished) - self.history)]:
+                del self.jobs[job.id]
+
+    # --- Persistance sous /data/spool : <id>.png (page) + <id>.json (métadonnées) ---
+
+    def _persist(self, job: PrintJob):
+        if not self.spool_dir:
+            return
+        try:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            base = os.path.join(self.spool_dir, job.id)
+            if job.page is not None:
+                job.page.save(base + ".png.tmp", format="PNG")
+                os.replace(base + ".png.tmp", base + ".png")
+            with open(base + ".json.tmp", "w") as f:
+                json.dump({"id": job.id, "priority": job.priority, "source": job.source, "created": job.created,
+                           "target": job.target, "blocks": _source_blocks(job.blocks)}, f)
+            os.replace(base + ".json.tmp", base + ".json")
+        except Exception as e:
+            log.warning(f"Job {job.id} non persisté : {e}")
+
+    def _unpersist(self, job: PrintJob):
+        if not self.spool_dir:
+            return
+        for ext in (".json", ".png"):
+            try:
+                os.remove(os.path.join(self.spool_dir, job.id + ext))
+            except FileNotFoundError:
+                pass
+
+    def _restore(self):
+        if not self.spool_dir or not os.path.isdir(self.spool_dir):
+            return
+        restored = []
+        for name in os.listdir(self.spool_dir):
+            if not name.endswith(".json"):
+                continue
+            base = os.path.join(self.spool_dir, name[:-5])
+            try:
+                with open(base + ".json") as f:
+                    meta = json.load(f)
+                page = None
+                if meta.get("blocks") is None:
+                    page = Image.open(base + ".png")
+                    page.load()
+                restored.append(PrintJob(page, meta.get("priority", 0), meta.get("source", "print"), meta["id"], meta.get("created"), meta.get("blocks"), meta.get("target")))
+            except Exception as e:
+                log.warning(f"Job persisté illisible ({name}) ignoré : {e}")
+                for ext in (".json", ".png"):
+                    try: os.remove(base + ext)
+                    except OSError: pass
+        for job in sorted(restored, key=lambda j: j.created):
+            with self._cond:
+                heapq.heappush(self._heap, (-job.priority, next(self._seq), job))
+                self.jobs[job.id] = job
+        if restored:
+            log.info(f"[{self.name}] {len(restored)} job(s) restauré(s) depuis {self.spool_dir}")
+
+def _source_blocks(items):
+    """Blocs JSON d'une liste à streamer : une région pré-rendue est remplacée par ses blocs d'origine."""
+    if items is None:
+        return None
+    return [b for item in items for b in (item.info.get("blocks", []) if isinstance(item, Image.Image) else [item])]
+
+class PrintDispatcher:
+    """Répartit les jobs entre les imprimantes, chacune avec sa file, son worker et son lien Bluetooth.
+
+    Un job cible une imprimante, un pool, ou n'importe laquelle : il part vers la moins chargée
+    des imprimantes en bonne santé, et bascule vers une autre si elle devient injoignable.
+    """
+    def __init__(self, spoolers: list):
+        self.spoolers = {s.name: s for s in spoolers}
+        for spooler in spoolers:
+            spooler.dispatcher = self
+
+    def candidates(self, target: str = None) -> list:
+        if target is None:
+            return list(self.spoolers.values())
+        if target in self.spoolers:
+            return [self.spoolers[target]]
+        return [s for s in self.spoolers.values() if s.pool == target]
+
+    def submit(self, job: PrintJob) -> str:
+        """Place le job. Retourne None, ou l'erreur à renvoyer au client."""
+        candidates = self.candidates(job.target)
+        if not candidates:
+            return f"Imprimante ou pool inconnu : {job.target}"
+        # Si aucune n'est en bonne santé, le job attend quand même sur la moins chargée
+        for spooler in sorted([s for s in candidates if s.healthy()] or candidates, key=PrintSpooler.load):
+            if spooler.submit(job):
+                return None
+        return f"File d'impression pleine ({sum(s.max_size for s in candidates)} jobs)"
+
+    def redispatch(self, job: PrintJob, origin: PrintSpooler) -> bool:
+        """Bascule un job d'une imprimante injoignable vers une autre, jamais deux fois la même."""
+        if job.target == origin.name:
+            return False
+        job.tried.add(origin.name)
+        candidates = [s for s in self.candidates(job.target) if s.name not in job.tried and s.healthy()]
+        for spooler in sorted(candidates, key=PrintSpooler.load):
+            if spooler.submit(job):
+                log.warning(f"Job {job.id} : {origin.name} injoignable, bascule vers {spooler.name}")
+                return True
+        return False
+
+    def get(self, job_id: str):
+        for spooler in self.spoolers.values():
+            job = spooler.get(job_id)
+            if job is not None:
+                return job
+        return None
+
+    def list(self) -> list:
+        return sorted((j for s in self.spoolers.values() for j in s.list()), key=lambda j: j["created"])
+
+    def depth(self) -> int:
+        return sum(s.depth() for s in self.spoolers.values())
 
-def _read_json(handler) -> tuple:
+    def busy(self) -> bool:
+        return any(s.busy.is_set() for s in self.spoolers.values())
+
+    def start(self):
+        for spooler in self.spoolers.values():
+            spooler.start()
+
+    def close(self):
+        for spooler in self.spoolers.values():
+            spooler.session.invalidate()
+
+def _printer_configs() -> list:
+    """Imprimantes de l'option `printers`, ou à défaut l'imprimante unique printer_mac / printer_model."""
+    printers = OPTIONS.get("printers") or []
+    if not printers:
+        return [{"name": "default", "mac": PRINTER_MAC, "model": PRINTER_MODEL, "pool": None, "backend": PRINTER_BACKEND}]
+    return [{"name": p.get("name") or f"printer{i + 1}", "mac": p.get("mac", ""), "model": p.get("model", "A6"), "pool": p.get("pool") or None,
+             "backend": p.get("backend") or PRINTER_BACKEND} for i, p in enumerate(printers)]
+
+def _spool_dir(name: str, single: bool):
+    if not PERSIST_QUEUE or not os.path.isdir(DATA_DIR):
+        return None
+    base = os.path.join(DATA_DIR, "spool")
+    return base if single else os.path.join(base, re.sub(r"[^A-Za-z0-9_-]", "_", name))
+
+PRINTER_CONFIGS = _printer_configs()
+DISPATCHER = PrintDispatcher([
+    PrintSpooler(QUEUE_SIZE, _spool_dir(c["name"], len(PRINTER_CONFIGS) == 1),
+                 session=PrinterSession(c["mac"], c["model"], BT_KEEPALIVE, c["name"], c["backend"]), pool=c["pool"])
+    for c in PRINTER_CONFIGS
+])
+
+Gauge("peripage_queue_depth", "Jobs en attente, par imprimante", ("printer",),
+      lambda: {(name,): s.depth() for name, s in DISPATCHER.spoolers.items()})
+Gauge("peripage_printer_busy", "1 si l'imprimante imprime", ("printer",),
+      lambda: {(name,): int(s.busy.is_set()) for name, s in DISPATCHER.spoolers.items()})
+Gauge("peripage_printer_healthy", "0 si l'imprimante est écartée après un échec", ("printer",),
+      lambda: {(name,): int(s.healthy()) for name, s in DISPATCHER.spoolers.items()})
+Gauge("peripage_bt_connects", "Connexions Bluetooth ouvertes depuis le démarrage", ("printer",),
+      lambda: {(name,): s.session.connects for name, s in DISPATCHER.spoolers.items()})
+Gauge("peripage_block_cache", "Cache des blocs rendus : hits, misses, entries, bytes", ("stat",),
+      lambda: {(k,): v for k, v in BLOCK_CACHE.stats().items() if k != "budget"})
+Gauge("peripage_render_waiting", "Requêtes en attente d'un créneau de rendu", (), lambda: {(): RENDER_SLOTS.waiting})
+
+def enqueue_job(data: dict, source: str, page: Image.Image = None, blocks: list = None) -> tuple:
+    """Place une page composée (ou des blocs à streamer) dans une file d'imprimante. Retourne (job, erreur)."""
+    target = data.get("printer") or None
+    job = PrintJob(page, _parse_priority(data.get("priority", 0)), source, blocks=blocks, target=target and str(target))
+    err = DISPATCHER.submit(job)
+    return (None, err) if err else (job, None)
+
+# --- Modèles de page : régions statiques pré-rendues, variables {{nom}} et emplacements ---
+
+TEMPLATE_DIR        = os.path.join(DATA_DIR, "templates")
+CONFIG_TEMPLATE_DIR = "/config/templates"  # addon_config, en lecture seule
+TEMPLATE_NAME       = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+PLACEHOLDER         = re.compile(r"\{\{\s*(\w+)\s*\}\}")
+
+def _placeholders(value) -> set:
+    """Noms des variables {{nom}} présentes dans une valeur JSON."""
+    if isinstance(value, str):
+        return set(PLACEHOLDER.findall(value))
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, list):
+        return set().union(*(_placeholders(v) for v in value))
+    return set()
+
+def _substitute(value, variables: dict):
+    if isinstance(value, str):
+        whole = PLACEHOLDER.fullmatch(value)
+        if whole:
+            return variables[whole.group(1)]  # valeur brute : une liste d'items reste une liste
+        return PLACEHOLDER.sub(lambda m: str(variables[m.group(1)]), value)
+    if isinstance(value, dict):
+        return {k: _substitute(v, variables) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_substitute(v, variables) for v in value]
+    return value
+
+class Template:
+    """Modèle compilé : chaque suite de blocs statiques est rendue une seule fois en bitmap.
+
+    Restent à rendre à chaque impression les blocs contenant des variables, les blocs réseau
+    (une image_url peut changer d'un appel à l'autre) et les emplacements `slot`.
+    """
+    def __init__(self, name: str, data: dict, readonly: bool = False):
+        blocks = data.get("blocks") if isinstance(data, dict) else None
+        if not isinstance(blocks, list) or not blocks or not all(isinstance(b, dict) for b in blocks):
+            raise ValueError("Champ 'blocks' manquant, vide ou invalide")
+        defaults = data.get("defaults", {})
+        if not isinstance(defaults, dict):
+            raise ValueError("Champ 'defaults' invalide")
+        self.name, self.data, self.readonly, self.defaults = name, data, readonly, defaults
+        self.variables, self.slots, self.regions = set(), [], []
+        static = []
+        for block in blocks:
+            block_type = block.get("type", "")
+            dynamic = block_type == "slot" or block_type in NETWORK_BLOCKS or _placeholders(block)
+            if not dynamic:
+                static.append(block)
+                continue
+            self._add_static(static)
+            static = []
+            if block_type == "slot":
+                if not block.get("name"):
+                    raise ValueError("Bloc slot : champ 'name' manquant")
+                self.slots.append(block["name"])
+            self.variables |= _placeholders(block)
+            self.regions.append(block)
+        self._add_static(static)
+
+    def _add_static(self, blocks: list):
+        if not blocks:
+            return
+        warnings = []
+        images   = list(iter_block_images(blocks, warnings))
+        if warnings:
+            raise ValueError("; ".join(warnings))
+        region = stack_images(images)
+        region.info["blocks"] = blocks  # pour la persistance des jobs streamés
+        self.regions.append(region)
+
+    def expand(self, variables: dict) -> list:
+        """Liste à composer : bitmaps statiques, blocs dynamiques complétés, contenu des emplacements."""
+        values  = {**self.defaults, **variables}
+        missing = self.variables - values.keys()
+        if missing:
+            raise ValueError(f"Variables manquantes : {', '.join(sorted(missing))}")
+        items = []
+        for region in self.regions:
+            if isinstance(region, Image.Image):
+                items.append(region)
+            elif region.get("type") == "slot":
+                content = variables.get(region["name"], [])
+                content = [content] if isinstance(content, dict) else content
+                if not isinstance(content, list) or not all(isinstance(b, dict) for b in content):
+                    raise ValueError(f"Emplacement '{region['name']}' : liste de blocs attendue")
+                items.extend(content)
+            else:
+                items.append(_substitute(region, values))
+        return items
+
+    def to_dict(self) -> dict:
+        static = [r for r in self.regions if isinstance(r, Image.Image)]
+        return {"name": self.name, "readonly": self.readonly, "variables": sorted(self.variables), "slots": self.slots,
+                "static_regions": len(static), "static_height": sum(r.height for r in static), **self.data}
+
+class TemplateStore:
+    """Modèles enregistrés par PUT /templates/<nom> (persistés) ou fournis dans /config/templates."""
+    def __init__(self, directory: str, config_directory: str = None):
+        self.directory        = directory
+        self.config_directory = config_directory
+        self._templates       = {}
+        self._lock            = threading.Lock()
+
+    def load(self):
+        """Compile les modèles sur disque ; ceux de /config priment et sont en lecture seule."""
+        for directory, readonly in ((self.directory, False), (self.config_directory, True)):
+            if not directory or not os.path.isdir(directory):
+                continue
+            for filename in sorted(os.listdir(directory)):
+                name = filename[:-5]
+                if not filename.endswith(".json") or not TEMPLATE_NAME.match(name):
+                    continue
+                try:
+                    with open(os.path.join(directory, filename)) as f:
+                        template = Template(name, json.load(f), readonly)
+                except Exception as e:
+                    log.warning(f"Modèle {filename} ignoré : {e}")
+                    continue
+                with self._lock:
+                    self._templates[name] = template
+        if self._templates:
+            log.info(f"{len(self._templates)} modèle(s) chargé(s) : {', '.join(sorted(self._templates))}")
+
+    def get(self, name: str):
+        with self._lock:
+            return self._templates.get(name)
+
+    def list(self) -> list:
+        with self._lock:
+            return [self._templates[name] for name in sorted(self._templates)]
+
+    def put(self, name: str, data: dict) -> Template:
+        existing = self.get(name)
+        if existing is not None and existing.readonly:
+            raise PermissionError(f"Modèle '{name}' défini dans /config, lecture seule")
+        template = Template(name, data)
+        if self.directory:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                path = os.path.join(self.directory, name + ".json")
+                with open(path + ".tmp", "w") as f:
+                    json.dump(data, f)
+                os.replace(path + ".tmp", path)
+            except OSError as e:
+                log.warning(f"Modèle {name} non persisté : {e}")
+        with self._lock:
+            self._templates[name] = template
+        return template
+
+    def delete(self, name: str) -> bool:
+        existing = self.get(name)
+        if existing is None:
+            return False
+        if existing.readonly:
+            raise PermissionError(f"Modèle '{name}' défini dans /config, lecture seule")
+        if self.directory:
+            try:
+                os.remove(os.path.join(self.directory, name + ".json"))
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._templates.pop(name, None)
+        return True
+
+TEMPLATES = TemplateStore(TEMPLATE_DIR if os.path.isdir(DATA_DIR) else None, CONFIG_TEMPLATE_DIR)
+
+# --- Couche HTTP commune aux serveurs threading et asyncio ---
+
+class Request:
+    """Requête HTTP indépendante du serveur : méthode, chemin, query, en-têtes et flux du body."""
+    def __init__(self, method: str, target: str, headers, rfile):
+        parts        = urllib.parse.urlsplit(target)
+        self.method  = method
+        self.path    = parts.path
+        self.query   = dict(urllib.parse.parse_qsl(parts.query))
+        self.headers = headers
+        self.rfile   = rfile
+        try:
+            self.content_length = int(headers.get("Content-Length") or 0)
+        except ValueError:
+            self.content_length = -1
+
+def _read_json(req: Request) -> tuple:
     try:
-        length = int(handler.headers.get("Content-Length", 0))
-        raw    = handler.rfile.read(length)
-        log.debug(f"BODY RECU ({length} bytes): {raw[:200]}")
-        return json.loads(raw), None
+        raw = req.rfile.read(req.content_length)
+        log.debug(f"BODY RECU ({req.content_length} bytes): {raw[:200]}")
+        started = time.perf_counter()
+        data = json.loads(raw)
+        _observe("json_parse", started)
+        return data, None
     except json.JSONDecodeError as e:
         return None, f"JSON invalide : {e}"
     except Exception as e:
         return None, f"Erreur lecture body : {e}"
 
-def _send(handler, code: int, payload: dict):
-    try:
+def _iter_body(req: Request, chunk_size: int = 65536):
+    """Lit le body par morceaux, directement depuis le socket."""
+    remaining = req.content_length
+    while remaining > 0:
+        chunk = req.rfile.read(min(chunk_size, remaining))
+        if not chunk:
+            raise ValueError("Body incomplet")
+        remaining -= len(chunk)
+        yield chunk
+
+def _spool(chunks):
+    """Copie un flux dans un fichier temporaire : SPOOL_MEMORY octets en mémoire, le reste sur disque."""
+    out = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY)
+    for chunk in chunks:
+        out.write(chunk)
+    out.seek(0)
+    return out
+
+def _multipart_file(chunks, boundary: str):
+    """Extrait en flux la première partie fichier d'un body multipart/form-data."""
+    delimiter = b"\r\n--" + boundary.encode("latin-1")
+    buf, out, state = b"\r\n", None, "preamble"
+    for chunk in chunks:
+        buf += chunk
+        while True:
+            if state == "preamble" or state == "skip":
+                idx = buf.find(delimiter)
+                if idx < 0:
+                    buf = buf[-len(delimiter):]
+                    break
+                buf, state = buf[idx + len(delimiter):], "headers"
+            elif state == "headers":
+                if buf.startswith(b"--"):
+                    return None  # fin du multipart sans fichier
+                end = buf.find(b"\r\n\r\n")
+                if end < 0:
+                    if len(buf) > 16384:
+                        raise ValueError("En-têtes multipart trop longs")
+                    break
+                part_headers, buf = buf[:end].decode("utf-8", "replace"), buf[end + 4:]
+                if "filename=" in part_headers:
+                    out, state = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY), "file"
+                else:
+                    state = "skip"
+            else:  # file
+                idx = buf.find(delimiter)
+                if idx >= 0:
+                    out.write(buf[:idx])
+                    out.seek(0)
+                    return out
+                keep = len(delimiter) - 1
+                if len(buf) > keep:
+                    out.write(buf[:-keep])
+                    buf = buf[-keep:]
+                break
+    raise ValueError("Body multipart incomplet")
+
+def _encode_response(code: int, payload, headers: dict = None) -> tuple:
+    """(en-têtes, body) : dict -> JSON, bytes -> tel quel (Content-Type fourni par `headers`)."""
+    headers = dict(headers or {})
+    if isinstance(payload, (bytes, bytearray)):
+        body = bytes(payload)
+        headers.setdefault("Content-Type", "application/octet-stream")
+    else:
         body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        headers.setdefault("Content-Type", "application/json; charset=utf-8")
+    headers["Content-Length"] = str(len(body))
+    return headers, body
+
+def _send(handler, code: int, payload, headers: dict = None):
+    try:
+        headers, body = _encode_response(code, payload, headers)
         handler.send_response(code)
-        handler.send_header("Content-Type", "application/json; charset=utf-8")
-        handler.send_header("Content-Length", len(body))
+        for name, value in headers.items():
+            handler.send_header(name, value)
         handler.end_headers()
         handler.wfile.write(body)
     except BrokenPipeError:
         pass  # Le client a ferme la connexion avant la reponse — impression deja effectuee
 
+def _busy_response() -> tuple:
+    return 429, {"error": "Trop de rendus en cours, réessayez plus tard"}, {"Retry-After": str(RETRY_AFTER)}
+
+def _queued_response(job, err, blocks: list, warnings: list, extra: dict = None) -> tuple:
+    if err:
+        return 503, {"error": err, "warnings": warnings}
+    # Repondre immediatement a HA, le worker imprime en arriere-plan
+    return 200, {"status": "queued", "job_id": job.id, "queue_depth": DISPATCHER.depth(), "printer": job.printer, "streaming": job.streaming,
+                 "blocks_rendered": len(blocks) - len(warnings), **(extra or {}), "warnings": warnings}
+
+def _unknown_printer(data: dict):
+    """Erreur si le champ `printer` ne désigne ni une imprimante ni un pool, vérifiée avant tout rendu."""
+    target = data.get("printer")
+    if target and not DISPATCHER.candidates(str(target)):
+        return 400, {"error": f"Imprimante ou pool inconnu : {target}"}
+    return None
+
+def _print_blocks(data: dict, blocks: list, source: str, extra: dict = None) -> tuple:
+    """Compose la page (ou la prépare pour le streaming) et la met en file. Répond aussitôt."""
+    unknown = _unknown_printer(data)
+    if unknown:
+        return unknown
+    if data.get("stream", STREAMING):
+        warnings = [f"Bloc #{i} : type inconnu '{b.get('type', '')}', ignoré" for i, b in enumerate(blocks)
+                    if not isinstance(b, Image.Image) and b.get("type", "") not in BLOCK_RENDERERS]
+        if len(warnings) == len(blocks):
+            return 422, {"error": "Aucun bloc n'a pu être rendu", "warnings": warnings}
+        job, err = enqueue_job(data, source, blocks=blocks)
+    else:
+        started = time.perf_counter()
+        fetched = prefetch_blocks(blocks)
+        # Nombre de rendus simultanés borné : file d'attente courte, puis le client est prié de revenir
+        if not RENDER_SLOTS.acquire():
+            return _busy_response()
+        try:
+            page, warnings = compose_page(fetched)
+        finally:
+            RENDER_SLOTS.release()
+        if page is None:
+            return 422, {"error": "Aucun bloc n'a pu être rendu", "warnings": warnings}
+        job, err = enqueue_job(data, source, page=page)
+        if job:
+            job.timings["render_s"] = round(time.perf_counter() - started, 4)
+    return _queued_response(job, err, blocks, warnings, extra)
+
+_health_seen = False
+
+def route_health(req: Request) -> tuple:
+    global _health_seen
+    if not _health_seen:
+        _health_seen = True
+        log.info(f"Premier /health {time.monotonic() - STARTED:.2f}s après le démarrage")
+    ok = all(c["backend"] != "bluetooth" or validate_mac(c["mac"]) for c in PRINTER_CONFIGS)
+    return 200 if ok else 503, {"status": "ok" if ok else "error", "mac": PRINTER_MAC, "model": PRINTER_MODEL, "printers": list(DISPATCHER.spoolers), "font": FONT_NAME, "font_size": FONT_SIZE, "port": PORT, "server": SERVER_MODE, "supported_blocks": list(BLOCK_RENDERERS.keys()), "block_cache": BLOCK_CACHE.stats(), "custom_fonts": {"ready": FONTS_READY.is_set(), "loaded": sorted(CUSTOM_FONT_CACHE)}, "endpoints": sorted({path for _, path in ROUTES} | {prefix + "<id>" for _, prefix in PREFIX_ROUTES})}
+
+def route_metrics(req: Request) -> tuple:
+    return 200, render_metrics().encode("utf-8"), {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+def route_status(req: Request) -> tuple:
+    return 200, {"busy": DISPATCHER.busy(), "queue_depth": DISPATCHER.depth(), "mac": PRINTER_MAC,
+                 "printers": [s.status() for s in DISPATCHER.spoolers.values()]}
+
+def route_jobs(req: Request) -> tuple:
+    return 200, {"queue_depth": DISPATCHER.depth(), "jobs": DISPATCHER.list()}
+
+def route_job(req: Request, job_id: str) -> tuple:
+    job = DISPATCHER.get(job_id)
+    if job is None:
+        return 404, {"error": "Job inconnu"}
+    return 200, job.to_dict()
+
+def route_print(req: Request) -> tuple:
+    data, err = _read_json(req)
+    if err:
+        return 400, {"error": err}
+    blocks = data.get("blocks", [])
+    if not isinstance(blocks, list) or len(blocks) == 0:
+        return 400, {"error": "Champ 'blocks' manquant ou vide"}
+    return _print_blocks(data, blocks, "print")
+
+def route_render(req: Request) -> tuple:
+    """POST /render : compose la page sans l'imprimer. PNG 1 bit, ou lignes 1 bit empaquetées (`format=raw`)."""
+    data, err = _read_json(req)
+    if err:
+        return 400, {"error": err}
+    blocks = data.get("blocks", [])
+    if not isinstance(blocks, list) or len(blocks) == 0:
+        return 400, {"error": "Champ 'blocks' manquant ou vide"}
+    fmt   = req.query.get("format") or data.get("format", "png")
+    model = req.query.get("model") or data.get("model", "A6")
+    if fmt not in ("png", "raw"):
+        return 400, {"error": "format : png ou raw"}
+    if model not in MODEL_WIDTHS:
+        return 400, {"error": f"Modèle inconnu : {model}"}
+    started = time.perf_counter()
+    fetched = prefetch_blocks(blocks)
+    if not RENDER_SLOTS.acquire():
+        return _busy_response()
+    try:
+        page, warnings = compose_page(fetched)
+    finally:
+        RENDER_SLOTS.release()
+    render_ms = (time.perf_counter() - started) * 1000
+    if page is None:
+        return 422, {"error": "Aucun bloc n'a pu être rendu", "warnings": warnings}
+    started = time.perf_counter()
+    if fmt == "png":
+        buf = io.BytesIO()
+        ImageChops.invert(print_bits(page)).save(buf, format="PNG")
+        body, content_type, width, row_bytes = buf.getvalue(), "image/png", page.width, (page.width + 7) // 8
+    else:
+        # Lignes telles qu'envoyées à l'imprimante : largeur du modèle, bit à 1 = point noir
+        width, row_bytes = MODEL_WIDTHS[model]
+        page = fit_band(page, width)
+        body, content_type = b"".join(pack_rows(page, row_bytes)), "application/octet-stream"
+    encode_ms = (time.perf_counter() - started) * 1000
+    return 200, body, {
+        "Content-Type": content_type,
+        "Server-Timing": f"render;dur={render_ms:.1f}, encode;dur={encode_ms:.1f}",
+        "X-Peripage-Width": str(width), "X-Peripage-Height": str(page.height), "X-Peripage-Row-Bytes": str(row_bytes),
+        "X-Peripage-Warnings": str(len(warnings)),
+    }
+
+def todo_blocks(lists: dict, data: dict) -> list:
+    """Mise en page de /print_todo : {entity_id: [éléments]} → blocs, une section par liste."""
+    if len(lists) == 1:
+        items = next(iter(lists.values())) or ["Aucun élément dans cette liste."]
+        return [
+            {"type": "title",     "text": data.get("title", "Ma liste"), "align": "center"},
+            {"type": "separator"},
+            {"type": "text",      "text": f"{len(items)} élément(s)", "align": "center", "font_size": 20},
+            {"type": "separator"},
+            {"type": "list",      "items": items},
+        ]
+    titles = data.get("titles") if isinstance(data.get("titles"), dict) else {}
+    blocks = [{"type": "title", "text": data.get("title", "Mes listes"), "align": "center"}]
+    for entity_id, items in lists.items():
+        name = titles.get(entity_id) or entity_id.split(".", 1)[-1].replace("_", " ").capitalize()
+        blocks += [
+            {"type": "separator"},
+            {"type": "text", "text": f"{name} ({len(items)})", "bold": True},
+            {"type": "list", "items": items or ["Aucun élément dans cette liste."]},
+        ]
+    return blocks
+
+def route_print_todo(req: Request) -> tuple:
+    data, err = _read_json(req)
+    if err:
+        return 400, {"error": err}
+    # Une liste (`entity_id`) ou plusieurs (`entity_ids`, ou `entity_id` en tableau) sur la même page
+    entity_ids = data.get("entity_ids") or data.get("entity_id", "")
+    entity_ids = [entity_ids] if isinstance(entity_ids, str) else entity_ids
+    if not isinstance(entity_ids, list) or not all(isinstance(e, str) for e in entity_ids):
+        return 400, {"error": "Champ 'entity_ids' invalide"}
+    entity_ids = list(dict.fromkeys(e.strip() for e in entity_ids if e.strip()))
+    if not entity_ids:
+        return 400, {"error": "Champ 'entity_id' manquant"}
+    lists, err = get_todo_lists(entity_ids, refresh=bool(data.get("refresh", False)))
+    if err:
+        return 500, {"error": err}
+    blocks = todo_blocks(lists, data)
+    if len(entity_ids) == 1:
+        return _print_blocks(data, blocks, "print_todo", {"items_count": len(blocks[-1]["items"])})
+    return _print_blocks(data, blocks, "print_todo", {"items_count": sum(len(i) for i in lists.values()), "lists": len(lists)})
+
+def route_templates(req: Request) -> tuple:
+    return 200, {"templates": [t.to_dict() for t in TEMPLATES.list()]}
+
+def route_template(req: Request, name: str) -> tuple:
+    """GET, PUT ou DELETE /templates/<nom>."""
+    if not TEMPLATE_NAME.match(name):
+        return 400, {"error": "Nom de modèle invalide (lettres, chiffres, - et _)"}
+    if req.method == "GET":
+        template = TEMPLATES.get(name)
+        return (200, template.to_dict()) if template else (404, {"error": "Modèle inconnu"})
+    try:
+        if req.method == "DELETE":
+            return (200, {"status": "deleted", "name": name}) if TEMPLATES.delete(name) else (404, {"error": "Modèle inconnu"})
+        data, err = _read_json(req)
+        if err:
+            return 400, {"error": err}
+        # La compilation rend les régions statiques : elle compte comme un rendu
+        if not RENDER_SLOTS.acquire():
+            return _busy_response()
+        try:
+            template = TEMPLATES.put(name, data)
+        finally:
+            RENDER_SLOTS.release()
+    except PermissionError as e:
+        return 409, {"error": str(e)}
+    except ValueError as e:
+        return 422, {"error": f"Modèle invalide : {e}"}
+    return 200, {"status": "saved", **template.to_dict()}
+
+def route_print_template(req: Request, name: str) -> tuple:
+    """POST /print/<nom> : seules les variables (`vars`) voyagent, les régions statiques sont déjà rendues."""
+    template = TEMPLATES.get(name)
+    if template is None:
+        return 404, {"error": "Modèle inconnu"}
+    data, err = _read_json(req)
+    if err:
+        return 400, {"error": err}
+    variables = data.get("vars", {})
+    if not isinstance(variables, dict):
+        return 400, {"error": "Champ 'vars' invalide"}
+    try:
+        items = template.expand(variables)
+    except ValueError as e:
+        return 400, {"error": str(e)}
+    return _print_blocks(data, items, "template", {"template": name})
+
+# Options de /print_image, en query (?dither=atkinson) ou en en-tête (X-Peripage-Dither)
+UPLOAD_OPTIONS = ("dither", "gamma", "contrast", "threshold", "max_height", "fit", "title", "caption", "priority", "printer")
+
+def route_print_image(req: Request) -> tuple:
+    """Image brute (image/*, application/octet-stream) ou multipart, lue en flux depuis le socket."""
+    if req.content_length <= 0:
+        return 411, {"error": "Content-Length requis"}
+    options = {}
+    for name in UPLOAD_OPTIONS:
+        value = req.query.get(name) or req.headers.get(f"X-Peripage-{name.replace('_', '-').title()}")
+        if value:
+            options[name] = value
+    unknown = _unknown_printer(options)
+    if unknown:
+        return unknown
+    content_type = req.headers.get("Content-Type") or "application/octet-stream"
+    try:
+        if content_type.startswith("multipart/form-data"):
+            boundary = content_type.partition("boundary=")[2].strip('"; ')
+            if not boundary:
+                return 400, {"error": "boundary multipart manquant"}
+            upload = _multipart_file(_iter_body(req), boundary)
+            if upload is None:
+                return 400, {"error": "Aucun fichier dans le formulaire"}
+        else:
+            upload = _spool(_iter_body(req))
+    except ValueError as e:
+        return 400, {"error": str(e)}
+    with upload:
+        if not RENDER_SLOTS.acquire():
+            return _busy_response()
+        try:
+            try:
+                photo = prepare_photo(_fit_image(Image.open(upload), *_fit_options(options)), options)
+            except Image.UnidentifiedImageError:
+                return 415, {"error": "Format d'image non reconnu"}
+            except Exception as e:
+                return 422, {"error": f"Image ou options invalides : {e}"}
+            blocks = [photo]
+            if options.get("title"):
+                blocks.insert(0, {"type": "title", "text": options["title"]})
+            if options.get("caption"):
+                blocks.append({"type": "text", "text": options["caption"], "align": "center"})
+            page, warnings = compose_page(blocks)
+        finally:
+            RENDER_SLOTS.release()
+    job, err = enqueue_job(options, "print_image", page=page)
+    return _queued_response(job, err, blocks, warnings, {"image_height": photo.height})
+
+# Routes qui lisent leur body en flux depuis le thread de rendu ; les autres le reçoivent déjà lu
+STREAMED_BODY_ROUTES = {"/print_image"}
+
+ROUTES = {
+    ("GET", "/health"): route_health,
+    ("GET", "/status"): route_status,
+    ("GET", "/jobs"): route_jobs,
+    ("POST", "/print"): route_print,
+    ("POST", "/print_todo"): route_print_todo,
+    ("POST", "/print_image"): route_print_image,
+    ("GET", "/templates"): route_templates,
+    ("GET", "/metrics"): route_metrics,
+    ("POST", "/render"): route_render,
+}
+
+# Routes à paramètre : (méthode, préfixe) -> handler(req, suffixe)
+PREFIX_ROUTES = {
+    ("GET", "/jobs/"): route_job,
+    ("GET", "/templates/"): route_template,
+    ("PUT", "/templates/"): route_template,
+    ("DELETE", "/templates/"): route_template,
+    ("POST", "/print/"): route_print_template,
+}
+
+def handle_request(req: Request) -> tuple:
+    """Aiguille une requête. Retourne (code, payload) ou (code, payload, en-têtes)."""
+    if req.content_length < 0:
+        return 400, {"error": "Content-Length invalide"}
+    if req.content_length > MAX_BODY_BYTES:
+        return 413, {"error": f"Requête trop volumineuse (max {MAX_BODY_BYTES // (1024 * 1024)} Mo)"}
+    route = ROUTES.get((req.method, req.path))
+    if route is not None:
+        return route(req)
+    for (method, prefix), route in PREFIX_ROUTES.items():
+        if req.method == method and req.path.startswith(prefix) and len(req.path) > len(prefix):
+            return route(req, req.path[len(prefix):])
+    return 404, {"error": "Route inconnue"}
+
 class LayoutHandler(BaseHTTPRequestHandler):
     def log_message(self, fmt, *args):
         log.info(fmt % args)
 
-    def do_GET(self):
-        if self.path == "/health":
-            ok = validate_mac(PRINTER_MAC)
-            _send(self, 200 if ok else 503, {"status": "ok" if ok else "error", "mac": PRINTER_MAC, "model": PRINTER_MODEL, "font": FONT_NAME, "font_size": FONT_SIZE, "port": PORT, "supported_blocks": list(BLOCK_RENDERERS.keys()), "endpoints": ["/print", "/print_todo", "/health", "/status"]})
-        elif self.path == "/status":
-            _send(self, 200, {"busy": printer_busy.is_set(), "mac": PRINTER_MAC})
-        else:
-            _send(self, 404, {"error": "Route inconnue"})
-
-    def do_POST(self):
-        if self.path == "/print":
-            data, err = _read_json(self)
-            if err:
-                return _send(self, 400, {"error": err})
-            blocks = data.get("blocks", [])
-            if not isinstance(blocks, list) or len(blocks) == 0:
-                return _send(self, 400, {"error": "Champ 'blocks' manquant ou vide"})
-            page, warnings = compose_page(blocks)
-            if page is None:
-                return _send(self, 422, {"error": "Aucun bloc n'a pu être rendu", "warnings": warnings})
-            # Repondre immediatement a HA, imprimer en arriere-plan
-            _send(self, 200, {"status": "queued", "blocks_rendered": len(blocks) - len(warnings), "warnings": warnings})
-            threading.Thread(target=send_to_printer, args=(page,), daemon=True).start()
-
-        elif self.path == "/print_todo":
-            data, err = _read_json(self)
-            if err:
-                return _send(self, 400, {"error": err})
-            entity_id = data.get("entity_id", "").strip()
-            title     = data.get("title", "Ma liste")
-            if not entity_id:
-                return _send(self, 400, {"error": "Champ 'entity_id' manquant"})
-            items, err = get_todo_items(entity_id)
-            if err:
-                return _send(self, 500, {"error": err})
-            if not items:
-                items = ["Aucun élément dans cette liste."]
-            blocks = [
-                {"type": "title",     "text": title, "align": "center"},
-                {"type": "separator"},
-                {"type": "text",      "text": f"{len(items)} élément(s)", "align": "center", "font_size": 20},
-                {"type": "separator"},
-                {"type": "list",      "items": items},
-            ]
-            page, warnings = compose_page(blocks)
-            if page is None:
-                return _send(self, 422, {"error": "Impossible de composer la page", "warnings": warnings})
-            # Repondre immediatement a HA, imprimer en arriere-plan
-            _send(self, 200, {"status": "queued", "items_count": len(items), "warnings": warnings})
-            threading.Thread(target=send_to_printer, args=(page,), daemon=True).start()
+    def _dispatch(self):
+        _send(self, *handle_request(Request(self.command, self.path, self.headers, self.rfile)))
 
+    do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+class _AsyncBodyReader:
+    """Flux bloquant (pour les threads de rendu) lisant le body depuis le StreamReader asyncio.
+
+    Chaque morceau doit arriver en KEEPALIVE_TIMEOUT secondes, et le body entier à BODY_MIN_RATE
+    octets/s au moins : un client lent n'immobilise pas un thread indéfiniment.
+    """
+    def __init__(self, reader: asyncio.StreamReader, length: int, loop: asyncio.AbstractEventLoop):
+        self.reader    = reader
+        self.remaining = length
+        self.loop      = loop
+        self.deadline  = time.monotonic() + KEEPALIVE_TIMEOUT + length / BODY_MIN_RATE
+
+    def timeout(self) -> float:
+        return max(0.0, self.deadline - time.monotonic())
+
+    def read(self, n: int = -1) -> bytes:
+        if n is None or n < 0 or n > self.remaining:
+            n = self.remaining
+        chunks = []
+        while n > 0:
+            future = asyncio.run_coroutine_threadsafe(self.reader.read(min(n, 65536)), self.loop)
+            try:
+                chunk = future.result(timeout=min(KEEPALIVE_TIMEOUT, self.timeout()))
+            except FuturesTimeout:
+                future.cancel()
+                raise ValueError("Body incomplet : client trop lent")
+            if not chunk:
+                break
+            chunks.append(chunk)
+            n -= len(chunk)
+            self.remaining -= len(chunk)
+        return b"".join(chunks)
+
+class AsyncHTTPServer:
+    """Serveur HTTP/1.1 asyncio : keep-alive, limites de taille, rendu déporté dans un pool de threads.
+
+    Au-delà de HTTP_WORKERS * 2 requêtes en cours, répond 429 sans rien lire ni rendre.
+    Les bodies sont lus dans la boucle avant de passer au pool (sauf STREAMED_BODY_ROUTES),
+    et les GET, peu coûteux, ont leur propre petit pool : /health répond même sous charge.
+    """
+    MAX_HEADERS = 100
+
+    def __init__(self, host: str, port: int):
+        self.host     = host
+        self.port     = port
+        self.active   = 0
+        self.streamed = 0  # uploads lus en flux depuis un thread : au plus HTTP_WORKERS // 2
+        self.executor = ThreadPoolExecutor(max_workers=HTTP_WORKERS, thread_name_prefix="http")
+        self.get_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="http-get")
+
+    async def serve(self):
+        server = await asyncio.start_server(self._client, self.host, self.port, reuse_address=True)
+        async with server:
+            await server.serve_forever()
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info("peername")
+        try:
+            while await self._handle_one(reader, writer, peer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            log.warning(f"Connexion HTTP {peer} : {e}")
+        finally:
+            writer.close()
+
+    async def _handle_one(self, reader, writer, peer) -> bool:
+        """Traite une requête ; retourne True si la connexion reste ouverte."""
+        try:
+            line = await asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return False
+        if not line:
+            return False
+        try:
+            method, target, version = line.decode("latin-1").split()
+            headers = http.client.HTTPMessage()
+            for _ in range(self.MAX_HEADERS + 1):
+                raw = await asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT)
+                if raw in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = raw.decode("latin-1").partition(":")
+                headers[name.strip()] = value.strip()
+            else:
+                await self._write(writer, 431, {"error": "Trop d'en-têtes"}, keep_alive=False)
+                return False
+        except (ValueError, asyncio.LimitOverrunError):
+            await self._write(writer, 400, {"error": "Requête HTTP invalide"}, keep_alive=False)
+            return False
+        except asyncio.TimeoutError:
+            return False
+        connection = (headers.get("Connection") or "").lower()
+        keep_alive = (version == "HTTP/1.1" and connection != "close") or connection == "keep-alive"
+        if "chunked" in (headers.get("Transfer-Encoding") or "").lower():
+            await self._write(writer, 411, {"error": "Content-Length requis"}, keep_alive=False)
+            return False
+        loop = asyncio.get_running_loop()
+        req  = Request(method, target, headers, None)
+        body = req.rfile = _AsyncBodyReader(reader, req.content_length if 0 < req.content_length <= MAX_BODY_BYTES else 0, loop)
+        light    = method == "GET"
+        streamed = bool(body.remaining) and req.path in STREAMED_BODY_ROUTES
+        if not light and (self.active >= HTTP_WORKERS * 2 or (streamed and self.streamed >= HTTP_WORKERS // 2)):
+            code, payload, extra = _busy_response()
         else:
-            _send(self, 404, {"error": "Route inconnue"})
+            self.active   += 1
+            self.streamed += streamed
+            try:
+                if body.remaining and not streamed:
+                    req.rfile = io.BytesIO(await asyncio.wait_for(reader.readexactly(body.remaining), body.timeout()))
+                    body.remaining = 0
+                code, payload, *rest = await loop.run_in_executor(self.get_executor if light else self.executor, handle_request, req)
+                extra = rest[0] if rest else None
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                return False  # client trop lent ou parti : connexion fermée sans réponse
+            except Exception as e:
+                log.error(f"Erreur interne sur {method} {target} : {e}")
+                code, payload, extra = 500, {"error": f"Erreur interne : {e}"}, None
+            finally:
+                self.active   -= 1
+                self.streamed -= streamed
+        # Body non lu (erreur précoce) : le vider s'il est petit, sinon fermer la connexion
+        if body.remaining > 0 or req.content_length > MAX_BODY_BYTES:
+            try:
+                if not 0 < body.remaining <= 65536:
+                    raise ValueError
+                await asyncio.wait_for(reader.readexactly(body.remaining), KEEPALIVE_TIMEOUT)
+            except (ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                keep_alive = False
+        log.info(f'{peer[0] if peer else "-"} "{method} {target} {version}" {code} -')
+        await self._write(writer, code, payload, extra, keep_alive)
+        return keep_alive
+
+    async def _write(self, writer, code: int, payload, extra: dict = None, keep_alive: bool = True):
+        headers, body = _encode_response(code, payload, extra)
+        headers["Connection"] = "keep-alive" if keep_alive else "close"
+        try:
+            phrase = HTTPStatus(code).phrase
+        except ValueError:
+            phrase = ""
+        head = f"HTTP/1.1 {code} {phrase}\r\n" + "".join(f"{k}: {v}\r\n" for k, v in headers.items()) + "\r\n"
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+def _load_fonts_background():
+    start = time.monotonic()
+    try:
+        if load_custom_fonts():
+            warm_fonts()
+            TEMPLATES.load()  # régions statiques rendues avec les anciennes polices
+    finally:
+        FONTS_READY.set()
+    if CUSTOM_FONT_CACHE:
+        log.info(f"Polices custom prêtes en {time.monotonic() - start:.1f}s : {', '.join(sorted(CUSTOM_FONT_CACHE))}")
 
 def main():
-    if not validate_mac(PRINTER_MAC):
-        log.error(f"Adresse MAC invalide ou placeholder : '{PRINTER_MAC}'")
+    for config in PRINTER_CONFIGS:
+        if config["backend"] not in PRINTER_BACKENDS:
+            log.error(f"Backend d'imprimante inconnu : '{config['backend']}' ({config['name']})")
+            sys.exit(1)
+        if config["backend"] == "bluetooth" and pp is None:
+            log.error("Module peripage absent : installez-le ou utilisez le backend 'fake'")
+            sys.exit(1)
+        if config["backend"] == "bluetooth" and not validate_mac(config["mac"]):
+            log.error(f"Adresse MAC invalide ou placeholder : '{config['mac']}' ({config['name']})")
+            sys.exit(1)
+    if len(DISPATCHER.spoolers) < len(PRINTER_CONFIGS):
+        log.error("Noms d'imprimantes en double dans l'option 'printers'")
         sys.exit(1)
 
     log.info(f"PeriPage Layout Addon démarré — port {PORT}")
-    log.info(f"Imprimante : {PRINTER_MODEL} @ {PRINTER_MAC}")
-    load_custom_fonts()
+    for config in PRINTER_CONFIGS:
+        log.info(f"Imprimante {config['name']} : {config['model']} @ {config['mac']}" + (f" (pool {config['pool']})" if config["pool"] else "")
+                 + (f" [backend {config['backend']}]" if config["backend"] != "bluetooth" else ""))
+    register_stored_fonts()
+    warm_fonts()
+    TEMPLATES.load()
+    # Le serveur démarre sans attendre le réseau : polices système en attendant les polices custom
+    threading.Thread(target=_load_fonts_background, name="fonts", daemon=True).start()
     log.info(f"Police par défaut : {FONT_NAME} {FONT_SIZE}px")
     # Avertir si une police système est absente
     for name in FONT_MAP:
@@ -557,6 +2843,16 @@ def main():
     if not any(os.path.exists(p) for p in EMOJI_FONT_PATHS):
         log.warning("Police emoji introuvable — les emojis s'afficheront en carré")
 
+    DISPATCHER.start()
+    log.info(f"Serveur HTTP : {SERVER_MODE}")
+    if SERVER_MODE == "asyncio":
+        try:
+            asyncio.run(AsyncHTTPServer("0.0.0.0", PORT).serve())
+        except KeyboardInterrupt:
+            log.info("Arrêt.")
+        finally:
+            DISPATCHER.close()
+        return
     ThreadingHTTPServer.allow_reuse_address = True
     server = ThreadingHTTPServer(("0.0.0.0", PORT), LayoutHandler)
     try:
@@ -565,6 +2861,7 @@ def main():
         log.info("Arrêt.")
     finally:
         server.server_close()
+        DISPATCHER.close()
 
 if __name__ == "__main__":
     main()